@@ -1,24 +1,41 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse, FileResponse
 from pydantic import BaseModel
 from typing import Optional, List, Union, Any
-from PIL import Image
-import os, pickle
-import requests
-import schedule
-from threading import Thread
+import inspect, json, asyncio, hashlib, hmac, threading
+from contextlib import nullcontext
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from starlette.background import BackgroundTask
+import os, pickle, sys
 
 from ..utils.image_utils import img_to_b64_string
-from ..utils.database_util import MongoUtil, DbUtil, JsonUtil
+from ..utils.database_util import MongoUtil, DbUtil, JsonUtil, ShardedJsonUtil, SqliteUtil
+from ..utils.blob_store import BlobStore, FileBlobStore, MongoBlobStore
+from ..utils.async_database_util import AsyncDbUtil, ThreadedAsyncDbUtil
+from ..utils.batching import MicroBatcher
+from ..utils.admission import AdmissionController, QueueFull
+from ..utils.reply_table import ReplyTable
+from ..utils.response_cache import ResponseCache, response_cache_key
+from ..utils.context_cache import ContextCache
+from ..utils.file_lock import FileLock
+from ..utils.timer_scheduler import TimerScheduler
+from ..utils.metrics import Metrics, enable_metrics, timed
+from ..utils.profiler import RequestProfiler
 from .the_message import TheMessage, MessageWrapper
 from .web_models import AboutResponse, MessageHistoryRequest, MessageHistoryResponse
 from .web_models import TemplateRequest, TemplateResponse, Template, ClearMessageHistoryRequest
 from .web_models import ParamCompenent, InterfaceParamsResponse, FeedbackRequest
-
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 import time
 
 
+# token counts kept in memory for get_message_context_budget(), by (tokenizer name, message_id)
+TOKEN_COUNT_CACHE_SIZE = 10000
+# serialized metadata responses kept, /templates are kept per user
+METADATA_CACHE_SIZE = 1024
+
+
 def preview_str(s, limit=16):
     if len(s) > limit:
         return s[:limit] + '..'
@@ -48,11 +65,13 @@ class BaseBot:
     -------
     "/bots/{self.__class__.__name__}/about" 
     "/bots/{self.__class__.__name__}/respond" 
+    "/bots/{self.__class__.__name__}/respond_stream" 
     "/bots/{self.__class__.__name__}/history" 
     "/bots/{self.__class__.__name__}/templates"
     "/bots/{self.__class__.__name__}/clear_message_history"
     "/bots/{self.__class__.__name__}/interface_params
     "/bots/{self.__class__.__name__}/feedback
+    "/bots/{self.__class__.__name__}/stats"
 
     Methods
     -------
@@ -84,17 +103,48 @@ class BaseBot:
             resp_message.set_images_pil(resp_images)
             return resp_message
         ```
+    respond_batch(self, messages: List[MessageWrapper]) -> List[Union[TheMessage, MessageWrapper]]
+        Used instead of respond() when the bot is created with max_batch_size. Receives the messages of concurrent
+          requests collected within batch_wait_seconds and returns one response per message, in the same order.
     _respond(self, request:TheMessage) -> TheMessage
         Wrapper around respond() that receives TheMessage, validates it, 
-          saves it by calling save_chat_message(), calls respond(), and returns TheMessage
+          saves it by calling save_chat_message(), calls respond(), and returns TheMessage.
+          Retries of a message_id get the reply of the first request instead of running it again (waiting at most reply_wait_seconds).
+    _respond_async(self, request:TheMessage) -> TheMessage
+        Same as _respond() for bots that define `async def respond()`, awaited on the event loop
+    save_chat_message_async, get_message_history_async, get_message_context_async
+        Awaitable versions of the methods below for use inside `async def respond()`
+    _respond_stream(self, request:TheMessage) -> StreamingResponse
+        Streams the reply as newline delimited JSON. respond() can be a (async) generator that yields partial text,
+          every chunk is sent as {"text": chunk} and the assembled message as a final {"message": TheMessage} line
+    _respond_admitted, _respond_stream_admitted
+        Used for /respond and /respond_stream when the bot is created with max_concurrency: at most max_concurrency
+          requests run at once, max_queue more wait their turn and the others are rejected with 429 and Retry-After
+    _profile(self, message:TheMessage)
+        With profile_every=N or profile_slower_than=seconds, /respond requests are profiled by a stack sampler and the profiles
+          are saved in cache_directory/profiles. With profile_admin_token they are listed at /profiles and downloaded at /profiles/{name}.
+    stats(self) -> dict
+        Runtime statistics served at /stats, e.g. the queue depth and wait times of the admission control
+          or the hit rate of the response cache
+    _cached_reply(self, message:TheMessage) -> Optional[TheMessage]
+        With cache_responses=True, replies are cached by the normalized text, extras['params'] and image hashes of
+          the message and identical messages get the cached reply without calling respond()
     clear_message_history(self, message: TheMessage) -> None
         Deletes all messages. Needs to be overriden if inheriting from BaseBot.
     save_chat_message(self, message: TheMessage) -> None
         Persists a message. Needs to be overriden if inheriting from BaseBot.
-    get_message_context(self, message:Union[TheMessage, MessageWrapper], limit=10, before_ts=None, descending:bool=True) -> List[MessageWrapper]:
+    get_message_context(self, message:Union[TheMessage, MessageWrapper], limit=10, before_ts=None, descending:bool=True, include_images:bool=True) -> List[MessageWrapper]:
         Uses get_message_history() to fetch the most recent messages to and from the same user as the input message.
         Should be overriden if you don't simply want the {limit} most recent messages as context.
-    get_message_history(self, user_id:str, limit=10, before_ts=None, descending:bool=True) -> List[TheMessage]
+        Pass include_images=False if you only need the text, so the images are not loaded.
+        With context_cache_size=K the last K messages of active users are kept in memory, updated as _respond() saves
+          messages, and contexts of up to K-1 messages are served without reading the database.
+    get_message_context_budget(self, message, max_tokens:int, count_tokens=None, tokenizer_name=None, ...) -> List[MessageWrapper]
+        Returns the most recent messages that fit in max_tokens, counted by count_tokens() (characters by default).
+          Counts are kept in memory by tokenizer name and message_id so they are computed once per message.
+    count_tokens(self, text:str) -> int
+        The default counter of get_message_context_budget(), override it with the tokenizer of your model
+    get_message_history(self, user_id:str, limit=10, before_ts=None, descending:bool=True, include_images:bool=True) -> List[TheMessage]
         Queries a database to find messages between this bot and the user. The app expects most recent message first (descending order by timestamp).
         Should be overriden if inheriting from BaseBot.
     _get_message_history(self, request: MessageHistoryRequest) -> MessageHistoryResponse
@@ -103,59 +153,89 @@ class BaseBot:
         Initializes and returns a new response message with all of the relevant fields set except for contents.
     about(self) -> AboutResponse 
         Returns the metadata of the bot AboutResponse(name=self.name, description=self.help(), icon={b64 str})
+    invalidate_metadata(self) -> None
+        /about, /templates and /interface_params are built once and served with an ETag (304 on a matching If-None-Match)
+          and Cache-Control max-age=metadata_max_age. Call this when about(), templates() or interface_params() change.
     set_endpoint_name(self, name:str) -> None
         Sets endpoint root name => f"/bots/{self.endpoint_name}/*"
     add_endpoints(self, app:FastAPI) -> None
         Adds the routing for the endpoints and corresponding functions
     """
     app = None
-    _scheduled_callbacks = []
-    _stopped = False
+    _bots = []
+    _scheduler = None
     # Class Methods
     @staticmethod
-    def start_app(*args) -> FastAPI:
+    def start_app(*args, metrics:bool=False) -> FastAPI:
+        """
+        Creates the FastAPI app serving the bots. metrics=True serves Prometheus metrics at /metrics
+          (request latencies, the steps of /respond, storage calls and image encoding), nothing is measured otherwise.
+        """
         app = FastAPI()
-        bot_timer_funcs = []
+        scheduler = TimerScheduler()
+        if metrics:
+            BaseBot._add_metrics(app, enable_metrics())
         for bot in args:
             if isinstance(bot, BaseBot):
+                if metrics:
+                    bot._instrument(enable_metrics())
                 bot.add_endpoints(app)
+                bot._warm_metadata()
                 if bot._timer_seconds is not None and bot._timer_seconds > 0:
-                    bot_timer_funcs.append((bot.timer, bot._timer_seconds))
+                    scheduler.add(bot.name, bot._run_timer, bot._timer_seconds, jitter=bot._timer_jitter_seconds, missed=bot._timer_missed)
             else:
                 print('ERROR LAUNCHING:', bot, 'is not an instance of BaseBot. Make sure you define your new class like so: class MyBot(BaseBot)')
 
         BaseBot.app = app
-        BaseBot._scheduled_callbacks = bot_timer_funcs
+        BaseBot._bots = [bot for bot in args if isinstance(bot, BaseBot)]
+        BaseBot._scheduler = scheduler
 
         if os.path.exists('static'):
+            from fastapi.staticfiles import StaticFiles
             app.mount("/static", StaticFiles(directory="static"), name="static")
 
-        def schedule_runner():
-            min_interval = float('inf')
-            for func, interval in BaseBot._scheduled_callbacks:
-                schedule.every(interval).seconds.do(func)
-                min_interval = min(min_interval, interval)
-            if min_interval != float('inf'):
-                now = int(time.time())
-                wait_time = min_interval - (now % min_interval)
-                start_time = wait_time + now
-                print(f'\tScheduler sleeping for {wait_time} seconds')
-                while time.time() < start_time and not BaseBot._stopped:
-                    time.sleep(1)
-                while True and not BaseBot._stopped:
-                    schedule.run_pending()
-                    time.sleep(1)
+        def startup_event():
+            scheduler.start()
         def shutdown_event():
             print('Stopping scheduler')
-            BaseBot._stopped = True
-            BaseBot._scheduler_thread.join()
-        BaseBot._scheduler_thread = Thread(target=schedule_runner)
-        BaseBot._scheduler_thread.start()
+            scheduler.stop()
+            for bot in BaseBot._bots:
+                try:
+                    bot.shutdown()
+                except Exception as e:
+                    print(f'{bot.name} failed to shut down with exception:\n\t', e)
+        app.add_event_handler(event_type='startup', func=startup_event)
         app.add_event_handler(event_type='shutdown', func=shutdown_event)
         return app
     
+    @staticmethod
+    def _add_metrics(app:FastAPI, metrics:Metrics) -> None:
+        @app.middleware('http')
+        async def measure_request(request:Request, call_next):
+            start = time.perf_counter()
+            response = await call_next(request)
+            route = request.scope.get('route')
+            path = route.path if route is not None else 'unmatched'
+            parts = path.split('/')
+            if len(parts) >= 3 and parts[1] == 'bots':
+                bot, endpoint = parts[2], '/'.join(parts[3:]) or 'root'
+            else:
+                bot, endpoint = '', path
+            # streamed responses are measured until their headers are sent
+            metrics.request_duration.observe((bot, endpoint), time.perf_counter() - start)
+            metrics.requests.inc((bot, endpoint, str(response.status_code)))
+            return response
+        app.add_api_route('/metrics', lambda: PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4'), methods=['GET'])
+
     # Instance Methods
-    def __init__(self, price:int=0, icon_path:str=None, bot_id:str=None, timer_seconds:int=None, cache_directory:str='bot_cache', suppress_warnings=False):
+    def __init__(self, price:int=0, icon_path:str=None, bot_id:str=None, timer_seconds:int=None, cache_directory:str='bot_cache', suppress_warnings=False,
+                 max_batch_size:int=None, batch_wait_seconds:float=0.01, max_concurrency:int=None, max_queue:int=16,
+                 reply_ttl_seconds:float=600, max_replies:int=10000, max_reply_bytes:int=64 * 2**20, reply_wait_seconds:float=300,
+                 cache_responses:bool=False, response_cache_size:int=256, response_cache_ttl:float=None, spill_responses:bool=False,
+                 metadata_max_age:int=60, context_cache_size:int=0, context_cache_users:int=1000, context_cache_idle_seconds:float=3600,
+                 timer_leader_election:bool=True, timer_jitter_seconds:float=0, timer_missed:str='skip',
+                 profile_every:int=None, profile_slower_than:float=None, profile_interval:float=0.005, max_profiles:int=100,
+                 profile_admin_token:str=None):
         self.name = 'bot.'+self.__class__.__name__
         if bot_id:
             self.bot_id = bot_id
@@ -165,6 +245,12 @@ class BaseBot:
         self.set_endpoint_name(self.__class__.__name__)
         self.price = price
         self._timer_seconds = timer_seconds
+        self._timer_jitter_seconds = timer_jitter_seconds
+        self._timer_missed = timer_missed
+        # with several worker processes only the one holding this lock runs timer()
+        self._timer_lock = None
+        if timer_leader_election:
+            self._timer_lock = FileLock(os.path.join(cache_directory, 'bot.'+self.__class__.__name__, 'timer.lock'))
         self._suppress_warnings = suppress_warnings
         if icon_path:
             self.icon_path = icon_path
@@ -175,10 +261,45 @@ class BaseBot:
                     self.icon_path = self.__class__.__name__+ext
         self.registered = False
         if os.path.exists(os.path.join('templates', 'index.html')) and os.path.exists(os.path.join('static', 'styles.css')):
+            from fastapi.templating import Jinja2Templates
             self.jinja_templates = Jinja2Templates(directory="templates")
         else:
             self.jinja_templates = None
         self.cache_directory = os.path.join(cache_directory, self.name)
+        self.blob_store: BlobStore = None
+        self._batcher = None
+        if max_batch_size:
+            if type(self).respond_batch is BaseBot.respond_batch and (inspect.iscoroutinefunction(self.respond) or inspect.isasyncgenfunction(self.respond)):
+                raise ValueError(f'{self.name}: max_batch_size needs a synchronous respond() or an override of respond_batch(). '
+                                 'An async respond() already waits on the event loop without holding a thread, batching it is not needed')
+            self._batcher = MicroBatcher(self.respond_batch, max_batch_size=max_batch_size, max_wait=batch_wait_seconds, name=f'{self.name}.batcher')
+        self._admission = None
+        if max_concurrency:
+            self._admission = AdmissionController(max_concurrency, max_queue=max_queue)
+        # replies by (sender_id, message_id) so client retries are answered without charging and responding again
+        self._replies = None
+        if reply_ttl_seconds and max_replies:
+            self._replies = ReplyTable(max_entries=max_replies, ttl=reply_ttl_seconds, max_bytes=max_reply_bytes)
+        self.reply_wait_seconds = reply_wait_seconds
+        self._response_cache = None
+        if cache_responses:
+            spill_directory = os.path.join(self.cache_directory, 'responses') if spill_responses else None
+            self._response_cache = ResponseCache(max_entries=response_cache_size, ttl=response_cache_ttl, spill_directory=spill_directory)
+        # serialized /about, /interface_params and /templates responses -> (body, etag)
+        self._metadata = OrderedDict() # least recently used first
+        self._metadata_lock = threading.Lock()
+        self.metadata_max_age = metadata_max_age
+        self._profiler = None
+        if profile_every or profile_slower_than:
+            self._profiler = RequestProfiler(os.path.join(self.cache_directory, 'profiles'), every=profile_every, slower_than=profile_slower_than,
+                                             interval=profile_interval, max_profiles=max_profiles)
+        self._profile_admin_token = profile_admin_token
+        self._token_counts = OrderedDict()
+        self._token_counts_lock = threading.Lock()
+        self._history_takes_include_images = None
+        self._context_cache = None
+        if context_cache_size:
+            self._context_cache = ContextCache(capacity=context_cache_size, max_users=context_cache_users, idle_seconds=context_cache_idle_seconds)
 
     def __repr__(self) -> str:
         return self.name + '\n\t'.join([v for k,v in vars(self).items() if k.startswith('endpoint_') and type(v) == str])
@@ -186,6 +307,11 @@ class BaseBot:
     def clear_message_history(self, request: ClearMessageHistoryRequest):
         print('clear_message_history method needs to be overriden')
 
+    def _clear_message_history(self, request: ClearMessageHistoryRequest):
+        if self._context_cache is not None:
+            self._context_cache.discard(request.user_id)
+        return self.clear_message_history(request)
+
     def interface_params(self) -> List[ParamCompenent]:
         """
         Defines the bot parameters screen in the app. See ParamComponent for more details.
@@ -284,22 +410,397 @@ class BaseBot:
         if message.contents.text:
             resp_msg.set_text('You said: ' + message.get_text())
         return resp_msg.get_message()
+    def _reply_key(self, message: TheMessage):
+        return (message.sender_id, message.message_id)
+
+    def _finish_reply(self, key, resp:TheMessage=None, exception:BaseException=None, keep:bool=True) -> None:
+        if key is None:
+            return
+        if exception is not None and not isinstance(exception, Exception):
+            exception = RuntimeError(f'The original request of message {key[1]} was interrupted')
+        size = 0
+        if resp is not None:
+            # images dominate the size of a reply
+            size = len(resp.contents.text or '') + sum(len(image) for image in resp.contents.image or [])
+        self._replies.finish(key, resp, exception=exception, size=size, keep=keep)
+
+    def _reply_timeout(self, key) -> HTTPException:
+        return HTTPException(status_code=409, detail=f'Message {key[1]} is still being answered, retry later')
+
+    def _wait_reply(self, key, future):
+        """
+        Waits for the reply of the original request of a retry, at most reply_wait_seconds
+        """
+        try:
+            return future.result(timeout=self.reply_wait_seconds)
+        except FutureTimeoutError:
+            raise self._reply_timeout(key)
+
+    async def _wait_reply_async(self, key, future):
+        try:
+            # shielded so that a retry giving up (or disconnecting) does not cancel the original request's future
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.reply_wait_seconds)
+        except asyncio.TimeoutError:
+            raise self._reply_timeout(key)
+
     def _respond(self, message: TheMessage):
         """
         Wrapper around respond() that receives TheMessage, validates it, 
-          saves it by calling save_chat_message(), calls respond(), and returns TheMessage
+          saves it by calling save_chat_message(), calls respond(), and returns TheMessage.
+          A retry of a message_id that is still running waits for it, a retry of a finished one gets its reply.
         """
-        valid_msg = self.validate_message(message)
-        if valid_msg is not None:
-            return valid_msg
-        # Not sure if I should save the validation messages?
-        self.save_chat_message(message)
-        resp = self.respond(MessageWrapper(message))
-        if type(resp) == TheMessage:
-            self.save_chat_message(resp)
-            return  resp
-        self.save_chat_message(resp.get_message())
-        return resp.get_message()
+        if self._replies is None:
+            with self._profile(message):
+                return self.validate_message(message) or self._respond_once(message)
+        key = self._reply_key(message)
+        future, owner = self._replies.claim(key)
+        if not owner:
+            return self._wait_reply(key, future)
+        try:
+            with self._profile(message):
+                valid_msg = self.validate_message(message)
+                resp = valid_msg or self._respond_once(message)
+        except BaseException as e:
+            self._finish_reply(key, exception=e)
+            raise
+        # a rejection (e.g. not enough credits) is not remembered, a retry after topping up must be answered
+        self._finish_reply(key, resp, keep=valid_msg is None)
+        return resp
+
+    def _profile(self, message: TheMessage):
+        """
+        Samples the stack of the request while it runs when the bot is created with profile_every or profile_slower_than.
+          Samples are kept only while the frame of the calling _respond() or _respond_async() runs, so the profile of an async
+          request does not include the other requests sharing the event loop, nor the time it spends awaiting.
+        """
+        if self._profiler is None:
+            return nullcontext()
+        return self._profiler.profile(message.message_id, frame=sys._getframe(1))
+
+    def _check_admin(self, request:Request) -> None:
+        expected = f'Bearer {self._profile_admin_token}'
+        if not hmac.compare_digest(request.headers.get('authorization', ''), expected):
+            raise HTTPException(status_code=401, detail='Invalid admin token')
+
+    def _list_profiles(self, request:Request) -> dict:
+        self._check_admin(request)
+        return { 'profiles': self._profiler.list() }
+
+    def _get_profile(self, name:str, request:Request) -> FileResponse:
+        self._check_admin(request)
+        path = self._profiler.path(name)
+        if path is None:
+            raise HTTPException(status_code=404, detail=f'No profile {name}')
+        return FileResponse(path, media_type='text/plain', filename=name)
+
+    def _respond_once(self, message: TheMessage):
+        """
+        Saves a validated message and its reply
+        """
+        self._save(message)
+        resp = self._cached_reply(message)
+        if resp is None:
+            if self._batcher is not None:
+                resp = self._batcher.submit(MessageWrapper(message)).result()
+            else:
+                resp = self.respond(MessageWrapper(message))
+            if inspect.isgenerator(resp):
+                resp = self._assemble_response(message, list(resp))
+            if type(resp) != TheMessage:
+                resp = resp.get_message()
+            self._cache_reply(message, resp)
+        self._save(resp)
+        return resp
+
+    async def _respond_async(self, message: TheMessage):
+        """
+        Same as _respond() for bots that define `async def respond()`. respond() and the storage calls are awaited
+          on the event loop, so a request waiting on a slow upstream API does not hold a threadpool thread.
+        """
+        if self._replies is None:
+            with self._profile(message):
+                # charge_credits() may block on an HTTP call
+                return await run_in_threadpool(self.validate_message, message) or await self._respond_async_once(message)
+        key = self._reply_key(message)
+        future, owner = self._replies.claim(key)
+        if not owner:
+            return await self._wait_reply_async(key, future)
+        try:
+            with self._profile(message):
+                valid_msg = await run_in_threadpool(self.validate_message, message)
+                resp = valid_msg or await self._respond_async_once(message)
+        except BaseException as e:
+            self._finish_reply(key, exception=e)
+            raise
+        self._finish_reply(key, resp, keep=valid_msg is None)
+        return resp
+
+    async def _respond_async_once(self, message: TheMessage):
+        await self._save_async(message)
+        resp = self._cached_reply(message)
+        if resp is None:
+            if self._batcher is not None:
+                resp = await asyncio.wrap_future(self._batcher.submit(MessageWrapper(message)))
+                if inspect.isgenerator(resp):
+                    resp = self._assemble_response(message, await run_in_threadpool(list, resp))
+            elif inspect.isasyncgenfunction(self.respond):
+                resp = self._assemble_response(message, [item async for item in self.respond(MessageWrapper(message))])
+            else:
+                resp = await self.respond(MessageWrapper(message))
+            if type(resp) != TheMessage:
+                resp = resp.get_message()
+            self._cache_reply(message, resp)
+        await self._save_async(resp)
+        return resp
+
+    def _cached_reply(self, message: TheMessage) -> Optional[TheMessage]:
+        """
+        Returns the cached reply to an identical earlier message (same text, params and images) when the bot
+          is created with cache_responses, as a new message to the sender of this one. None otherwise.
+        """
+        if self._response_cache is None:
+            return None
+        cached = self._response_cache.get(response_cache_key(message))
+        if cached is None:
+            return None
+        reply = self.get_message_to(message.sender_id).get_message()
+        return cached.copy(update={ 'timestamp': reply.timestamp, 'message_id': reply.message_id, 'recipient_id': reply.recipient_id }, deep=True)
+
+    def _cache_reply(self, message: TheMessage, resp: TheMessage) -> None:
+        if self._response_cache is not None:
+            self._response_cache.put(response_cache_key(message), resp.copy(deep=True))
+
+    def _respond_is_async(self) -> bool:
+        # batched requests wait for their batch on the event loop instead of holding a threadpool thread
+        return inspect.iscoroutinefunction(self.respond) or inspect.isasyncgenfunction(self.respond) or self._batcher is not None
+
+    async def _admit(self) -> float:
+        """
+        Waits for one of the max_concurrency slots of the bot, or fails right away with 429 when max_queue requests are already waiting
+        """
+        try:
+            return await self._admission.acquire()
+        except QueueFull as e:
+            raise HTTPException(status_code=429, detail=f'{self.name} is busy, please retry later', headers={ 'Retry-After': str(e.retry_after) })
+
+    async def _respond_admitted(self, message: TheMessage):
+        """
+        /respond of bots created with max_concurrency: runs _respond() or _respond_async() once admitted
+        """
+        # retries only wait for the original request, they do not need a slot
+        previous = self._replies.get(self._reply_key(message)) if self._replies is not None else None
+        if previous is not None:
+            return await self._wait_reply_async(self._reply_key(message), previous)
+        await self._admit()
+        start = time.monotonic()
+        try:
+            if self._respond_is_async():
+                return await self._respond_async(message)
+            return await run_in_threadpool(self._respond, message)
+        finally:
+            self._admission.release(time.monotonic() - start)
+
+    async def _respond_stream_admitted(self, message: TheMessage):
+        """
+        /respond_stream of bots created with max_concurrency: the slot is held until the stream ends
+        """
+        previous = self._replies.get(self._reply_key(message)) if self._replies is not None else None
+        if previous is not None:
+            return self._message_stream(await self._wait_reply_async(self._reply_key(message), previous))
+        await self._admit()
+        start = time.monotonic()
+        try:
+            resp = await self._respond_stream(message)
+        except BaseException:
+            self._admission.release(time.monotonic() - start)
+            raise
+        body_iterator = resp.body_iterator
+        background = resp.background
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._admission.release(time.monotonic() - start)
+
+        async def stream():
+            try:
+                async for chunk in body_iterator:
+                    yield chunk
+            finally:
+                release()
+
+        async def after_response():
+            # also frees the slot when the body is never iterated, e.g. the client disconnected before it started
+            release()
+            if background is not None:
+                await background()
+        resp.body_iterator = stream()
+        resp.background = BackgroundTask(after_response)
+        return resp
+
+    def stats(self) -> dict:
+        """
+        Runtime statistics of the bot served at /stats: running requests, queue depth and wait times when created with max_concurrency
+        """
+        out = { 'bot': self.name }
+        if self._admission is not None:
+            out['admission'] = self._admission.stats()
+        if self._replies is not None:
+            out['replies'] = self._replies.stats()
+        if self._response_cache is not None:
+            out['response_cache'] = self._response_cache.stats()
+        if self._context_cache is not None:
+            out['context_cache'] = self._context_cache.stats()
+        if BaseBot._scheduler is not None and self.name in BaseBot._scheduler.stats():
+            out['timer'] = dict(BaseBot._scheduler.stats()[self.name], leader=self._timer_lock is None or self._timer_lock.held)
+        return out
+
+    def _assemble_response(self, message: TheMessage, items: list) -> TheMessage:
+        """
+        Builds the reply of a streaming respond() from what it yielded: text chunks (str) are concatenated,
+          a yielded TheMessage or MessageWrapper is used as the reply message (e.g. to attach images)
+        """
+        chunks = []
+        resp = None
+        for item in items:
+            if isinstance(item, str):
+                chunks.append(item)
+            elif isinstance(item, MessageWrapper):
+                resp = item.get_message()
+            elif isinstance(item, TheMessage):
+                resp = item
+        if resp is None:
+            resp = self.get_message_to(message.sender_id).get_message()
+        if resp.contents.text is None and chunks:
+            resp.contents.text = ''.join(chunks)
+        return resp
+
+    async def _respond_items(self, message: TheMessage):
+        """
+        Calls respond() whatever its flavor and yields what it produces, for _respond_stream()
+        """
+        if self._batcher is not None:
+            resp = await asyncio.wrap_future(self._batcher.submit(MessageWrapper(message)))
+            if inspect.isgenerator(resp):
+                async for item in iterate_in_threadpool(resp):
+                    yield item
+            else:
+                yield resp
+        elif inspect.isasyncgenfunction(self.respond):
+            async for item in self.respond(MessageWrapper(message)):
+                yield item
+        elif inspect.isgeneratorfunction(self.respond):
+            async for item in iterate_in_threadpool(self.respond(MessageWrapper(message))):
+                yield item
+        elif inspect.iscoroutinefunction(self.respond):
+            yield await self.respond(MessageWrapper(message))
+        else:
+            yield await run_in_threadpool(self.respond, MessageWrapper(message))
+
+    async def _respond_stream(self, message: TheMessage):
+        """
+        Same as _respond() but streams the reply as newline delimited JSON: {"text": chunk} for every chunk
+          of text respond() yields, then {"message": TheMessage} once the reply is assembled and saved.
+        """
+        key = None
+        if self._replies is not None:
+            future, owner = self._replies.claim(self._reply_key(message))
+            if not owner:
+                # a retry only gets the complete reply
+                return self._message_stream(await self._wait_reply_async(self._reply_key(message), future))
+            key = self._reply_key(message)
+        try:
+            valid_msg = await run_in_threadpool(self.validate_message, message)
+            if valid_msg is not None:
+                self._finish_reply(key, valid_msg, keep=False)
+                return self._message_stream(valid_msg)
+            await self._save_async(message)
+        except BaseException as e:
+            self._finish_reply(key, exception=e)
+            raise
+
+        async def stream():
+            try:
+                resp = self._cached_reply(message)
+                if resp is None:
+                    items = []
+                    async for item in self._respond_items(message):
+                        items.append(item)
+                        if isinstance(item, str):
+                            yield json.dumps({ 'text': item }) + '\n'
+                    resp = self._assemble_response(message, items)
+                    self._cache_reply(message, resp)
+                await self._save_async(resp)
+            except BaseException as e:
+                self._finish_reply(key, exception=e)
+                raise
+            self._finish_reply(key, resp)
+            yield json.dumps({ 'message': resp.dict() }) + '\n'
+
+        async def release():
+            # the body is never iterated when the client disconnects before it starts, retries must not wait for it
+            self._finish_reply(key, exception=RuntimeError(f'The original request of message {message.message_id} was not completed'))
+        return StreamingResponse(stream(), media_type='application/x-ndjson', background=BackgroundTask(release))
+
+    def _message_stream(self, message: TheMessage) -> StreamingResponse:
+        return StreamingResponse(iter([json.dumps({ 'message': message.dict() }) + '\n']), media_type='application/x-ndjson')
+
+    async def save_chat_message_async(self, message: TheMessage):
+        """
+        Awaitable save_chat_message(). Runs save_chat_message() in the threadpool unless overriden.
+        """
+        await run_in_threadpool(self.save_chat_message, message)
+
+    async def get_message_history_async(self, user_id:str, limit=10, before_ts=None, descending:bool=True, include_images:bool=True) -> List[TheMessage]:
+        """
+        Awaitable get_message_history(). Runs get_message_history() in the threadpool unless overriden.
+        """
+        return await run_in_threadpool(self.get_message_history, user_id, limit=limit, before_ts=before_ts, descending=descending,
+                                       **self._history_kwargs(include_images))
+
+    async def get_message_context_async(self, message:Union[TheMessage, MessageWrapper], limit=10, before_ts=None, descending:bool=True, include_images:bool=True) -> List[MessageWrapper]:
+        """
+        Awaitable get_message_context()
+        """
+        if type(message) == MessageWrapper:
+            message = message.get_message()
+        previous_messages = self._cached_context(message.sender_id, limit+1, before_ts, descending, include_images)
+        if previous_messages is None:
+            if self._context_cache is not None and before_ts is None and limit+1 <= self._context_cache.capacity:
+                self._context_cache.load(message.sender_id, await self.get_message_history_async(message.sender_id, limit=self._context_cache.capacity))
+                previous_messages = self._cached_context(message.sender_id, limit+1, before_ts, descending, include_images)
+            else:
+                previous_messages = await self.get_message_history_async(message.sender_id, limit=limit+1, before_ts=before_ts, descending=descending, include_images=include_images)
+        return self._context_from_history(message, previous_messages, limit)
+
+    async def get_message_context_budget_async(self, message:Union[TheMessage, MessageWrapper], max_tokens:int, count_tokens=None, tokenizer_name:str=None,
+                                               max_messages:int=100, page_size:int=10, descending:bool=True, include_images:bool=False) -> List[MessageWrapper]:
+        """
+        Awaitable get_message_context_budget()
+        """
+        if type(message) == MessageWrapper:
+            message = message.get_message()
+        selected = []
+        budget = { 'tokens': max_tokens, 'messages': max_messages }
+        before_ts = None
+        while True:
+            page = await self.get_message_context_async(message, limit=page_size, before_ts=before_ts, include_images=include_images)
+            if not self._take_within_budget(page, selected, budget, count_tokens, tokenizer_name) or len(page) < page_size:
+                break
+            before_ts = page[-1].get_message().timestamp
+        if not descending:
+            selected = list(reversed(selected))
+        return selected
+
+    def respond_batch(self, messages: List[MessageWrapper]) -> List[Union[TheMessage, MessageWrapper]]:
+        """
+        Used instead of respond() when the bot is created with max_batch_size: receives the messages of up to
+          max_batch_size concurrent requests and must return one response per message, in the same order.
+          Override it to call a backend that is faster on batches (e.g. a GPU model). Calls respond() one by one by default.
+        """
+        return [self.respond(message) for message in messages]
 
     def save_chat_message(self, message: TheMessage):
         """
@@ -308,21 +809,140 @@ class BaseBot:
         if not self._suppress_warnings:
             print(f'{self.name} WARNING: save_chat_message(message:TheMessage) function should be overriden!')
         return
-    def get_message_context(self, message:Union[TheMessage, MessageWrapper], limit=10, before_ts=None, descending:bool=True) -> List[MessageWrapper]:
+    def get_message_context(self, message:Union[TheMessage, MessageWrapper], limit=10, before_ts=None, descending:bool=True, include_images:bool=True) -> List[MessageWrapper]:
         """
         Uses get_message_history() to fetch the most recent messages to and from the same user as the input message.
         Should be overriden if you don't simply want the {limit} most recent messages as context.
+        Pass include_images=False if you only need the text, so the images are not loaded.
         """
         if type(message) == MessageWrapper:
             message = message.get_message()
-        previous_messages = self.get_message_history(message.sender_id, limit=limit+1, before_ts=before_ts, descending=descending)
+        previous_messages = self._cached_context(message.sender_id, limit+1, before_ts, descending, include_images)
+        if previous_messages is None:
+            if self._context_cache is not None and before_ts is None and limit+1 <= self._context_cache.capacity:
+                # a miss loads the whole buffer of the user, images included so it can serve any later read
+                self._context_cache.load(message.sender_id, self.get_message_history(message.sender_id, limit=self._context_cache.capacity))
+                previous_messages = self._cached_context(message.sender_id, limit+1, before_ts, descending, include_images)
+            else:
+                previous_messages = self.get_message_history(message.sender_id, limit=limit+1, before_ts=before_ts, descending=descending,
+                                                             **self._history_kwargs(include_images))
+        return self._context_from_history(message, previous_messages, limit)
+    def count_tokens(self, text:str) -> int:
+        """
+        Size of a text for get_message_context_budget(). Counts characters unless overriden, e.g. with the tokenizer of your model:
+        ```
+        def count_tokens(self, text):
+            return len(tiktoken.encoding_for_model('gpt-3.5-turbo').encode(text))
+        ```
+        """
+        return len(text)
+    def _message_tokens(self, message:TheMessage, count_tokens=None, tokenizer_name:str=None) -> int:
+        """
+        Token count of a message. Counts of self.count_tokens(), or of a count_tokens passed with a tokenizer_name,
+          are kept in memory by (tokenizer name, message_id) for the TOKEN_COUNT_CACHE_SIZE most recently used messages.
+        """
+        if count_tokens is None:
+            count_tokens, tokenizer_name = self.count_tokens, 'count_tokens'
+        if tokenizer_name is None:
+            # an anonymous tokenizer (lambda, partial) cannot be told apart from another one, so it is not cached
+            return count_tokens(message.contents.text or '')
+        key = (tokenizer_name, message.message_id)
+        with self._token_counts_lock:
+            tokens = self._token_counts.get(key)
+            if tokens is not None:
+                self._token_counts.move_to_end(key)
+                return tokens
+        tokens = count_tokens(message.contents.text or '')
+        with self._token_counts_lock:
+            self._token_counts[key] = tokens
+            while len(self._token_counts) > TOKEN_COUNT_CACHE_SIZE:
+                self._token_counts.popitem(last=False)
+        return tokens
+    def _take_within_budget(self, page:List[MessageWrapper], selected:List[MessageWrapper], budget:dict, count_tokens, tokenizer_name:str=None) -> bool:
+        """
+        Moves the messages of a page (most recent first) into selected while they fit in budget['tokens'], returns False once one does not
+        """
+        for msg in page:
+            tokens = self._message_tokens(msg.get_message(), count_tokens, tokenizer_name)
+            if tokens > budget['tokens'] or len(selected) >= budget['messages']:
+                return False
+            budget['tokens'] -= tokens
+            selected.append(msg)
+        return True
+    def get_message_context_budget(self, message:Union[TheMessage, MessageWrapper], max_tokens:int, count_tokens=None, tokenizer_name:str=None,
+                                   max_messages:int=100, page_size:int=10, descending:bool=True, include_images:bool=False) -> List[MessageWrapper]:
+        """
+        Like get_message_context() but returns the most recent messages whose texts fit in max_tokens together,
+          as counted by count_tokens(text) (defaults to self.count_tokens(), characters unless overriden).
+          Pass a tokenizer_name with count_tokens to keep its counts in memory, they are recomputed on every call otherwise.
+        The history is read page_size messages at a time, so only about as many messages as returned are read and counted.
+        The budget is for the context only, keep room for the input message and the reply.
+        """
+        if type(message) == MessageWrapper:
+            message = message.get_message()
+        selected = []
+        budget = { 'tokens': max_tokens, 'messages': max_messages }
+        before_ts = None
+        while True:
+            page = self.get_message_context(message, limit=page_size, before_ts=before_ts, include_images=include_images)
+            if not self._take_within_budget(page, selected, budget, count_tokens, tokenizer_name) or len(page) < page_size:
+                break
+            before_ts = page[-1].get_message().timestamp
+        if not descending:
+            selected = list(reversed(selected))
+        return selected
+    def _conversation_user(self, message:TheMessage) -> str:
+        if message.sender_id in [self.bot_id, self.name]:
+            return message.recipient_id
+        return message.sender_id
+
+    def _save(self, message:TheMessage) -> None:
+        """
+        save_chat_message() and write-through to the context cache, used by _respond() for every message it persists
+        """
+        self.save_chat_message(message)
+        if self._context_cache is not None:
+            self._context_cache.add(self._conversation_user(message), message)
+
+    async def _save_async(self, message:TheMessage) -> None:
+        await self.save_chat_message_async(message)
+        if self._context_cache is not None:
+            self._context_cache.add(self._conversation_user(message), message)
+
+    def _cached_context(self, user_id:str, limit:int, before_ts, descending:bool, include_images:bool) -> Optional[List[TheMessage]]:
+        """
+        History of the context cache for get_message_context(), None when it has to be read from storage
+        """
+        if self._context_cache is None or before_ts is not None:
+            return None
+        messages = self._context_cache.get(user_id, limit)
+        if messages is None:
+            return None
+        if not include_images:
+            messages = [msg.copy(update={ 'contents': msg.contents.copy(update={ 'image': [] }) }) if msg.contents.image else msg for msg in messages]
+        if not descending:
+            messages = list(reversed(messages))
+        return messages
+
+    def _history_kwargs(self, include_images:bool) -> dict:
+        """
+        include_images=False for get_message_history(), unless it is overriden without include_images
+        """
+        if include_images:
+            return {}
+        if self._history_takes_include_images is None:
+            parameters = inspect.signature(self.get_message_history).parameters.values()
+            self._history_takes_include_images = any(p.name == 'include_images' or p.kind == p.VAR_KEYWORD for p in parameters)
+        return { 'include_images': False } if self._history_takes_include_images else {}
+
+    def _context_from_history(self, message:TheMessage, previous_messages:List[TheMessage], limit:int) -> List[MessageWrapper]:
         if previous_messages:
-            return [MessageWrapper(message=msg) for msg in previous_messages if msg.message_id != message.message_id][:limit]
+            return [MessageWrapper(message=msg, blob_store=self.blob_store) for msg in previous_messages if msg.message_id != message.message_id][:limit]
         return []
-    def get_message_history(self, user_id:str, limit=10, before_ts=None, descending:bool=True) -> List[TheMessage]:
+    def get_message_history(self, user_id:str, limit=10, before_ts=None, descending:bool=True, include_images:bool=True) -> List[TheMessage]:
         """
         Queries a database to find messages between this bot and the user. The app expects most recent message first (descending order by timestamp).
-        Should be overriden if inheriting from BaseBot.
+        With include_images=False the images can be left out of the messages. Should be overriden if inheriting from BaseBot.
         """
         if not self._suppress_warnings:
             print(f'{self.name} WARNING: get_message_history(user_id, limit, ...) function should be overriden!')
@@ -332,6 +952,8 @@ class BaseBot:
         Wrapper around get_message_history that expects and returns the WebModels
         """
         messages = self.get_message_history(request.user_id, request.limit, before_ts=request.before_ts, descending=True)
+        if self.blob_store is not None:
+            messages = [self.blob_store.rehydrate(msg) for msg in messages]
         return MessageHistoryResponse(messages=messages)
     def get_message_to(self, user_id) -> MessageWrapper:
         """
@@ -345,6 +967,7 @@ class BaseBot:
         icon = None
         if self.icon_path is not None:
             try:
+                from PIL import Image
                 icon = Image.open(self.icon_path).convert('RGB').resize((64,64))
                 icon = img_to_b64_string(icon)
             except Exception as e:
@@ -352,6 +975,65 @@ class BaseBot:
                 icon = None
                 pass
         return AboutResponse(name=self.name, icon=icon, bot_id=self.bot_id, price=self.price)
+    def invalidate_metadata(self) -> None:
+        """
+        Drops the cached /about, /templates and /interface_params responses, so they are rebuilt on their next request.
+          Call it when the icon, price, templates or interface params of the bot change while it is running.
+        """
+        with self._metadata_lock:
+            self._metadata = OrderedDict()
+
+    def _metadata_response(self, request:Request, key, build) -> Response:
+        """
+        Serves the JSON produced by build() once per key (until invalidate_metadata()) with an ETag,
+          answering conditional GETs whose If-None-Match matches with 304 Not Modified
+        """
+        with self._metadata_lock:
+            metadata = self._metadata
+            entry = metadata.get(key)
+            if entry is not None:
+                metadata.move_to_end(key)
+        if entry is None:
+            body = build().encode('utf-8')
+            entry = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+            with self._metadata_lock:
+                # into the table read above, so a response built before invalidate_metadata() is not kept
+                metadata[key] = entry
+                while len(metadata) > METADATA_CACHE_SIZE:
+                    metadata.popitem(last=False)
+        body, etag = entry
+        cache_control = f'max-age={self.metadata_max_age}' if self.metadata_max_age else 'no-cache'
+        headers = { 'ETag': etag, 'Cache-Control': cache_control }
+        if request.method == 'GET':
+            if_none_match = request.headers.get('if-none-match')
+            # weak validators (W/"...") match too, If-None-Match uses the weak comparison
+            tags = [tag.strip() for tag in if_none_match.split(',')] if if_none_match else []
+            if '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]:
+                return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type='application/json', headers=headers)
+
+    def _serve_about(self, request:Request) -> Response:
+        return self._metadata_response(request, 'about', lambda: self.about().json())
+
+    def _serve_interface_params(self, request:Request) -> Response:
+        return self._metadata_response(request, 'interface_params', lambda: self._interface_params().json())
+
+    def _serve_templates(self, request:Request, template_request:Optional[TemplateRequest]=None) -> Response:
+        user_id = template_request.user_id if template_request is not None else None
+        return self._metadata_response(request, ('templates', user_id), lambda: self._templates(template_request).json())
+
+    def _warm_metadata(self) -> None:
+        """
+        Builds the /about, /interface_params and /templates responses at startup instead of on the first request
+        """
+        request = Request({ 'type': 'http', 'method': 'POST', 'headers': [] })
+        try:
+            self._serve_about(request)
+            self._serve_interface_params(request)
+            self._serve_templates(request)
+        except Exception as e:
+            print(f'{self.name} failed to build its metadata with exception:\n\t', e)
+
     def get_root(self):
         return { 'Bot': self.name }
 
@@ -395,11 +1077,41 @@ class BaseBot:
             return obj
         return None
     
+    def _instrument(self, metrics:Metrics) -> None:
+        """
+        Times the steps of /respond by replacing them with timed wrappers on the instance, only done when metrics are enabled
+        """
+        for phase in ['validate_message', 'charge_credits', 'respond', 'respond_batch', 'save_chat_message', 'save_chat_message_async',
+                      'get_message_history', 'get_message_history_async']:
+            setattr(self, phase, timed(getattr(self, phase), metrics.phase_duration, (self.endpoint_name, phase)))
+        if self._batcher is not None:
+            self._batcher.process_batch = self.respond_batch
+
     def timer(self):
         if not self._suppress_warnings:
             print(f'{self.name} WARNING: timer(self) function should be overriden!')
         pass
 
+    def _run_timer(self) -> bool:
+        """
+        Runs timer() in the leader process only: when the app runs with several workers (uvicorn --workers N, gunicorn)
+          the first to take the timer lock in cache_directory runs the timers and another one takes over if it dies.
+          Returns whether timer() ran, so the other workers do not count runs in their stats.
+        """
+        if self._timer_lock is not None and not self._timer_lock.try_acquire():
+            return False
+        self.timer()
+        return True
+
+    def shutdown(self) -> None:
+        """
+        Called when the app shuts down. Override to flush buffers or release resources (and call super().shutdown()).
+        """
+        if self._batcher is not None:
+            self._batcher.close()
+        if self._timer_lock is not None:
+            self._timer_lock.release()
+
     def set_endpoint_name(self, name):
         self.endpoint_name = name
     def add_endpoints(self, app:FastAPI):
@@ -413,47 +1125,150 @@ class BaseBot:
             app.add_api_route(f'/bots/{self.endpoint_name}', self._get_homepage, methods=['GET'])
         else: 
             app.add_api_route(f'/bots/{self.endpoint_name}', self.get_root, methods=['GET'])
-        app.add_api_route(f'/bots/{self.endpoint_name}/respond', self._respond,  methods=["POST"], response_model=TheMessage)
-        app.add_api_route(f'/bots/{self.endpoint_name}/about', self.about,  methods=["GET"])
+        if self._admission is not None:
+            # admission happens on the event loop, so waiting requests do not hold threadpool threads
+            app.add_api_route(f'/bots/{self.endpoint_name}/respond', self._respond_admitted,  methods=["POST"], response_model=TheMessage)
+            app.add_api_route(f'/bots/{self.endpoint_name}/respond_stream', self._respond_stream_admitted,  methods=["POST"])
+        else:
+            if self._respond_is_async():
+                app.add_api_route(f'/bots/{self.endpoint_name}/respond', self._respond_async,  methods=["POST"], response_model=TheMessage)
+            else:
+                app.add_api_route(f'/bots/{self.endpoint_name}/respond', self._respond,  methods=["POST"], response_model=TheMessage)
+            app.add_api_route(f'/bots/{self.endpoint_name}/respond_stream', self._respond_stream,  methods=["POST"])
+        app.add_api_route(f'/bots/{self.endpoint_name}/about', self._serve_about,  methods=["GET"], response_model=AboutResponse)
         app.add_api_route(f'/bots/{self.endpoint_name}/history', self._get_message_history,  methods=["POST"], response_model=MessageHistoryResponse)
-        app.add_api_route(f'/bots/{self.endpoint_name}/templates', self._templates, methods=['GET','POST'], response_model=TemplateResponse)
-        app.add_api_route(f'/bots/{self.endpoint_name}/clear_message_history', self.clear_message_history, methods=['POST'])
-        app.add_api_route(f'/bots/{self.endpoint_name}/interface_params', self._interface_params, methods=['GET','POST'])
+        app.add_api_route(f'/bots/{self.endpoint_name}/templates', self._serve_templates, methods=['GET','POST'], response_model=TemplateResponse)
+        app.add_api_route(f'/bots/{self.endpoint_name}/clear_message_history', self._clear_message_history, methods=['POST'])
+        app.add_api_route(f'/bots/{self.endpoint_name}/interface_params', self._serve_interface_params, methods=['GET','POST'], response_model=InterfaceParamsResponse)
         app.add_api_route(f'/bots/{self.endpoint_name}/feedback', self._feedback, methods=['POST'])
+        app.add_api_route(f'/bots/{self.endpoint_name}/stats', self.stats, methods=['GET'])
+        if self._profiler is not None and self._profile_admin_token:
+            app.add_api_route(f'/bots/{self.endpoint_name}/profiles', self._list_profiles, methods=['GET'])
+            app.add_api_route(f'/bots/{self.endpoint_name}/profiles/{{name}}', self._get_profile, methods=['GET'])
 
 
 
 
 
 class BaseBotWithLocalDb(BaseBot):
-    def __init__(self, db_util: DbUtil = None, json_directory='conversations', **kwargs):
+    """
+    BaseBot that persists its conversations itself.
+
+    storage selects the DbUtil when db_util is not passed:
+        None      -> MongoUtil if MONGO_URI is set, otherwise 'journal'
+        'mongo'   -> MongoUtil (requires MONGO_URI)
+        'json'    -> JsonUtil, rewrites <json_directory>/<bot_id>_messages.json on every write, feedback included
+        'journal' -> JsonUtil with an append-only journal, write cost independent of history size
+        'sharded' -> ShardedJsonUtil, one file per user loaded on demand, idle users are evicted from memory
+        'sqlite'  -> SqliteUtil, indexed embedded database <json_directory>/<bot_id>.sqlite
+
+    write_behind=True makes the 'journal' and 'sharded' stores acknowledge writes from memory and
+    persist them in fsynced batches from a background thread, at most flush_interval seconds later.
+    For 'mongo' it buffers the writes and sends them with bulk_write. Buffered writes are flushed
+    when the app shuts down. Either way /respond and /feedback succeed before the write is durable:
+    a crash loses the last flush_interval seconds of writes, and so does a MongoDB outage lasting
+    longer than the retries of MongoUtil.
+
+    externalize_images=True stores message images once per distinct content in a blob store
+    (<json_directory>/blobs, or a collection for 'mongo') and keeps only references in the history.
+    Pass blob_store to use your own BlobStore.
+
+    Bots with an `async def respond()` use async_db_util for the /respond storage calls. It defaults to
+    running db_util on its own executor, or pass e.g. AsyncMongoUtil() for a natively async driver.
+    Overrides of save_chat_message() or get_message_history() are used instead of async_db_util on the async path too.
+    """
+    def __init__(self, db_util: DbUtil = None, json_directory='conversations', storage:str=None,
+                 write_behind:bool=False, flush_interval:float=0.05,
+                 externalize_images:bool=False, blob_store:BlobStore=None,
+                 async_db_util:AsyncDbUtil=None, **kwargs):
         super().__init__(**kwargs)
+        if storage is None:
+            # the journal reads the same <bot_id>_messages.json, so histories of the former 'json' default still load
+            storage = 'mongo' if 'MONGO_URI' in os.environ else 'journal'
         if db_util:
             self.db_util = db_util
+        elif storage == 'mongo':
+            self.db_util = MongoUtil(buffered=write_behind, flush_interval=flush_interval)
+            try:
+                self.db_util.create_index_if_not_exists(self.bot_id, 'sender_id')
+                self.db_util.create_index_if_not_exists(self.bot_id, 'recipient_id')
+            except Exception as e:
+                print('Failed to create indexes with exception: ', e)
+        elif storage == 'json':
+            self.db_util = JsonUtil(bot_id=self.bot_id, json_directory=json_directory)
+        elif storage == 'journal':
+            self.db_util = JsonUtil(bot_id=self.bot_id, json_directory=json_directory, journaled=True,
+                                    write_behind=write_behind, flush_interval=flush_interval)
+        elif storage == 'sharded':
+            self.db_util = ShardedJsonUtil(bot_id=self.bot_id, json_directory=json_directory,
+                                           write_behind=write_behind, flush_interval=flush_interval)
+        elif storage == 'sqlite':
+            self.db_util = SqliteUtil(db_path=os.path.join(json_directory, self.bot_id + '.sqlite'))
         else:
-            if 'MONGO_URI' in os.environ:
-                self.db_util = MongoUtil()
-                try:
-                    self.db_util.create_index_if_not_exists(self.bot_id, 'sender_id')
-                    self.db_util.create_index_if_not_exists(self.bot_id, 'recipient_id')
-                except Exception as e:
-                    print('Failed to create indexes with exception: ', e)
-                
+            raise ValueError(f"Unknown storage '{storage}', expected one of: 'mongo', 'json', 'journal', 'sharded', 'sqlite'")
+        if write_behind and (db_util or storage not in ['journal', 'sharded', 'mongo']):
+            print(f'{self.name} WARNING: write_behind is only supported by the journal, sharded and mongo storage, ignoring it')
+        if blob_store:
+            self.blob_store = blob_store
+        elif externalize_images:
+            if isinstance(self.db_util, MongoUtil):
+                self.blob_store = MongoBlobStore(self.db_util.mongo)
             else:
-                self.db_util = JsonUtil(bot_id=self.bot_id, json_directory=json_directory)
+                self.blob_store = FileBlobStore(os.path.join(json_directory, 'blobs'))
+        if async_db_util:
+            self.async_db_util = async_db_util
+        else:
+            self.async_db_util = ThreadedAsyncDbUtil(self.db_util)
+
+    def _instrument(self, metrics:Metrics) -> None:
+        super()._instrument(metrics)
+        db_utils = [self.db_util, self.async_db_util]
+        if isinstance(self.async_db_util, ThreadedAsyncDbUtil) and self.async_db_util.db_util is self.db_util:
+            # its calls run the already timed db_util, they would be counted twice
+            db_utils = [self.db_util]
+        for db_util in db_utils:
+            backend = type(db_util).__name__
+            for operation in ['save_chat_message', 'get_chat_messages', 'rate_message', 'clear_chat_history']:
+                setattr(db_util, operation, timed(getattr(db_util, operation), metrics.storage_duration, (self.endpoint_name, backend, operation)))
+
+    def shutdown(self) -> None:
+        super().shutdown()
+        self.async_db_util.close()
+        self.db_util.close()
     
     def clear_message_history(self, request: ClearMessageHistoryRequest):
         self.db_util.clear_chat_history(self.bot_id, request.user_id)
     def save_chat_message(self, message: TheMessage):
+        if self.blob_store is not None:
+            message = self.blob_store.externalize(message)
         self.db_util.save_chat_message(self.bot_id, message)
         return
 
+    def _overrides(self, name:str) -> bool:
+        return getattr(type(self), name) is not getattr(BaseBotWithLocalDb, name)
+
+    async def save_chat_message_async(self, message: TheMessage):
+        if self._overrides('save_chat_message'):
+            # a subclass that changes how messages are saved must see the saves of async bots too
+            return await super().save_chat_message_async(message)
+        if self.blob_store is not None:
+            message = self.blob_store.externalize(message)
+        await self.async_db_util.save_chat_message(self.bot_id, message)
+
     def feedback(self, message_id: str, rating: float) -> None:
         self.db_util.rate_message(self.bot_id, message_id, rating)
         pass
 
-    def get_message_history(self, user_id:str, limit:int=10, before_ts:float=None, descending:bool=True) -> List[TheMessage]:
-        messages = self.db_util.get_chat_messages(bot=self.bot_id, user_id=user_id,limit=limit, before_ts=before_ts)
+    def get_message_history(self, user_id:str, limit:int=10, before_ts:float=None, descending:bool=True, include_images:bool=True) -> List[TheMessage]:
+        messages = self.db_util.get_chat_messages(bot=self.bot_id, user_id=user_id,limit=limit, before_ts=before_ts, include_images=include_images)
+        if not descending:
+            messages = list(reversed(messages))
+        return messages
+
+    async def get_message_history_async(self, user_id:str, limit:int=10, before_ts:float=None, descending:bool=True, include_images:bool=True) -> List[TheMessage]:
+        if self._overrides('get_message_history'):
+            return await super().get_message_history_async(user_id, limit=limit, before_ts=before_ts, descending=descending, include_images=include_images)
+        messages = await self.async_db_util.get_chat_messages(bot=self.bot_id, user_id=user_id, limit=limit, before_ts=before_ts, include_images=include_images)
         if not descending:
             messages = list(reversed(messages))
         return messages
@@ -470,13 +1285,14 @@ class RegisteredBaseBot(BaseBot):
         url = self.url + '/bots/charge_credits'
         d = { 'message_id': message_id }
         headers = {"Authorization": f"Bearer {self.bot_token}" }
+        import requests
         resp = requests.post(url, json=d, headers=headers)
         if resp.status_code == 200:
             return True
         else:
             return False
 
-    def get_message_history(self, user_id:str, limit:int=10, before_ts:float=None, descending:bool=True) -> List[TheMessage]:
+    def get_message_history(self, user_id:str, limit:int=10, before_ts:float=None, descending:bool=True, include_images:bool=True) -> List[TheMessage]:
         url = self.url + '/messages/get_message_history'
         d = {
             'user_id': user_id,
@@ -485,16 +1301,21 @@ class RegisteredBaseBot(BaseBot):
             'limit': limit,
         }
         headers = {"Authorization": f"Bearer {self.bot_token}"}
+        import requests
         resp = requests.post(url, json=d, headers=headers)
         assert resp.status_code < 300, f'Error retrieving messages with status code {resp.status_code}'
         messages = resp.json().get('messages', [])
         if not descending:
             messages = list(reversed(messages))
         messages = [TheMessage.parse_obj(msg) for msg in messages]
+        if not include_images:
+            for msg in messages:
+                msg.contents.image = []
         return messages
     def save_chat_message(self, message: TheMessage):
         url = self.url + '/messages/add_message'
         headers = {"Authorization": f"Bearer {self.bot_token}"}
+        import requests
         resp = requests.post(url, json=message.dict(), headers=headers)
         assert resp.status_code < 300, f'Error saving message with status code {resp.status_code}'
         pass
@@ -502,6 +1323,7 @@ class RegisteredBaseBot(BaseBot):
     def clear_message_history(self, request: ClearMessageHistoryRequest):
         url = self.url + '/messages/clear_message_history'
         headers = {"Authorization": f"Bearer {self.bot_token}"}
+        import requests
         resp = requests.post(url, json=request.dict(), headers=headers)
         assert resp.status_code < 300, f'Error saving message with status code {resp.status_code}'
         return {}
@@ -2,7 +2,7 @@
 from typing import Optional, List
 from pydantic import BaseModel
 from ..utils.image_utils import b64_string_to_img, img_to_b64_string
-from PIL import Image
+from ..utils.blob_store import is_blob_ref
 import uuid, time
 
 
@@ -31,10 +31,12 @@ class MessageWrapper:
     ----------
     message : TheMessage
         the underlying message that gets sent as a response to the /respond request
+    blob_store : BlobStore
+        resolves the 'blob:sha256:...' image references of messages loaded from storage, None if images are stored inline
 
     Methods
     -------
-    __init__(self, message:TheMessage = None, sender_id:str ='', recipient_id:str='') -> None
+    __init__(self, message:TheMessage = None, sender_id:str ='', recipient_id:str='', blob_store=None) -> None
         Initializes the MessageWrapper. Takes either a TheMessage as input 
           or the sender and recipient, in which case it initializes the rest of the attributes
           automatically: timestamp and message_id
@@ -73,12 +75,13 @@ class MessageWrapper:
     set_extra_property(self, key:str, value:str)
         Sets key value on the extras dict
     """
-    def __init__(self, message:TheMessage = None, sender_id:str ='', recipient_id:str=''):
+    def __init__(self, message:TheMessage = None, sender_id:str ='', recipient_id:str='', blob_store=None):
         """
         Initializes the MessageWrapper. Takes either a TheMessage as input 
           or the sender and recipient, in which case it initializes the rest of the attributes
           automatically: timestamp and message_id
         """
+        self.blob_store = blob_store
         if message:
             self.message = message
         else:
@@ -106,12 +109,16 @@ class MessageWrapper:
         Returns the images in the message as PIL.Image types
         """
         if self.message.contents.image:
-            return [b64_string_to_img(img_str) for img_str in self.message.contents.image]
+            return [b64_string_to_img(img_str) for img_str in self.get_images_b64()]
         return None
     def get_images_b64(self) -> list:
         """
         Returns the images in the message as base64 encoded strings
         """
+        images = self.message.contents.image
+        if self.blob_store is not None and images and any(is_blob_ref(img) for img in images):
+            # loaded lazily the first time the images are needed
+            self.message.contents.image = self.blob_store.resolve(images)
         return self.message.contents.image
     def set_images_pil(self, images):
         """
@@ -1,2 +1,4 @@
-from .database_util import MongoUtil
+from .database_util import MongoUtil, JsonUtil, ShardedJsonUtil, SqliteUtil
+from .async_database_util import AsyncDbUtil, ThreadedAsyncDbUtil, AsyncMongoUtil
+from .blob_store import BlobStore, FileBlobStore, MongoBlobStore
 from .image_utils import * 
@@ -0,0 +1,94 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+
+class QueueFull(Exception):
+    """
+    Raised by AdmissionController.acquire() when the queue is full. retry_after is a hint in seconds.
+    """
+    def __init__(self, retry_after:int):
+        super().__init__(f'Queue full, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits how many requests of a bot run at once. Up to max_concurrency requests run, up to max_queue more
+    wait in FIFO order and the rest are rejected with QueueFull right away.
+    Lives on the event loop: acquire() and release() must be called from the loop thread.
+    """
+    def __init__(self, max_concurrency:int, max_queue:int=16):
+        assert max_concurrency > 0, 'max_concurrency must be positive'
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.service_time = None # exponential moving average of the time a request holds its slot
+
+    def retry_after(self) -> int:
+        """
+        Seconds until the queue should have drained, estimated from the recent service time
+        """
+        service_time = self.service_time or 1.0
+        return max(1, math.ceil(service_time * (len(self._waiters) + 1) / self.max_concurrency))
+
+    async def acquire(self) -> float:
+        """
+        Waits for a slot and returns the time spent waiting, or raises QueueFull
+        """
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return 0.0
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(self.retry_after())
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as the request was cancelled, pass it on
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        wait = time.monotonic() - start
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    def release(self, service_time:float=None) -> None:
+        """
+        Frees a slot, handing it over to the oldest waiting request if there is one
+        """
+        if service_time is not None:
+            self.service_time = service_time if self.service_time is None else 0.8 * self.service_time + 0.2 * service_time
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'active': self.active,
+            'queue_depth': len(self._waiters),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'mean_wait_seconds': self.total_wait / self.admitted if self.admitted else 0.0,
+            'max_wait_seconds': self.max_wait,
+            'mean_service_seconds': self.service_time or 0.0,
+        }
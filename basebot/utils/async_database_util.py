@@ -0,0 +1,94 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from ..models.the_message import TheMessage
+from .database_util import DbUtil, USER_ID, TO_USER_ID, TS, MESSAGE_ID, IMAGES, SET, LESS_THAN, OR
+
+
+class AsyncDbUtil:
+    """
+    Async counterpart of DbUtil, used by bots that define `async def respond` so that
+    their requests never wait on storage from a threadpool thread.
+    """
+    async def save_chat_message(self, bot:str, message:TheMessage) -> None:
+        raise NotImplementedError("Abstract method")
+
+    async def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None, include_images:bool=True) -> List[TheMessage]:
+        raise NotImplementedError("Abstract method")
+
+    async def clear_chat_history(self, bot:str, user_id:str) -> None:
+        raise NotImplementedError("Abstract method")
+
+    async def rate_message(self, bot:str, message_id:str, rating:float) -> None:
+        raise NotImplementedError("Abstract method")
+
+    def close(self) -> None:
+        pass
+
+
+class ThreadedAsyncDbUtil(AsyncDbUtil):
+    """
+    Runs the calls of a synchronous DbUtil on its own executor, so they get awaited from the event loop
+    without taking threads from the threadpool FastAPI shares between all sync endpoints. The sync endpoints
+    already call the DbUtil from several threads at once, so by default the executor is sized like a
+    ThreadPoolExecutor (min(32, cpu count + 4) threads). Pass max_workers=1 for a DbUtil that is not thread safe.
+    """
+    def __init__(self, db_util:DbUtil, max_workers:int=None):
+        self.db_util = db_util
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='basebot-db')
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+
+    async def save_chat_message(self, bot:str, message:TheMessage) -> None:
+        return await self._run(self.db_util.save_chat_message, bot, message)
+
+    async def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None, include_images:bool=True) -> List[TheMessage]:
+        return await self._run(self.db_util.get_chat_messages, bot, user_id, limit=limit, before_ts=before_ts, include_images=include_images)
+
+    async def clear_chat_history(self, bot:str, user_id:str) -> None:
+        return await self._run(self.db_util.clear_chat_history, bot, user_id)
+
+    async def rate_message(self, bot:str, message_id:str, rating:float) -> None:
+        return await self._run(self.db_util.rate_message, bot, message_id, rating)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+class AsyncMongoUtil(AsyncDbUtil):
+    """
+    MongoUtil on the motor asyncio driver (pip install motor). Requires the MONGO_URI environment variable.
+    """
+    def __init__(self):
+        try:
+            from motor.motor_asyncio import AsyncIOMotorClient
+        except ImportError:
+            raise ImportError('AsyncMongoUtil requires the motor package: pip install motor')
+        self.mongo = AsyncIOMotorClient(os.environ['MONGO_URI'], retryWrites=False)
+
+    async def rate_message(self, bot:str, message_id:str, rating:float) -> None:
+        await self.mongo.db[bot].update_one({ MESSAGE_ID: message_id }, { SET: { 'feedback': rating } })
+
+    async def save_chat_message(self, bot:str, message:TheMessage) -> None:
+        await self.mongo.db[bot].update_one({ MESSAGE_ID: message.message_id }, { SET: message.dict() }, upsert=True)
+
+    async def clear_chat_history(self, bot:str, user_id:str) -> None:
+        await self.mongo.db[bot].delete_many({ USER_ID: user_id })
+        await self.mongo.db[bot].delete_many({ TO_USER_ID: user_id })
+
+    async def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None, include_images:bool=True) -> List[TheMessage]:
+        criteria = { OR: [ { USER_ID: user_id }, { TO_USER_ID: user_id } ] }
+        if before_ts is not None:
+            criteria[TS] = { LESS_THAN: before_ts }
+        projection = { '_id': False, 'feedback': False }
+        if not include_images:
+            projection[IMAGES] = False
+        cursor = self.mongo.db[bot].find(criteria, projection).sort(TS, -1).limit(limit)
+        return [TheMessage.parse_obj(msg_dict) async for msg_dict in cursor]
+
+    def close(self) -> None:
+        self.mongo.close()
@@ -0,0 +1,71 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List
+
+
+class MicroBatcher:
+    """
+    Collects items submitted concurrently from many threads and hands them to process_batch(items) together,
+    once max_batch_size items are waiting or max_wait seconds after the first one arrived.
+    process_batch must return one result per item, in order. Each submit() returns a Future of its result.
+    """
+    def __init__(self, process_batch:Callable[[list], list], max_batch_size:int=8, max_wait:float=0.01, name:str='batcher'):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = [] # (item, Future)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._batch_runner, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('MicroBatcher is closed')
+            self._pending.append((item, future))
+            self._cond.notify()
+        return future
+
+    def _next_batch(self) -> List:
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch_size and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            return batch
+
+    def _batch_runner(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                if self._stopped:
+                    return
+                continue
+            items = [item for item, _ in batch]
+            try:
+                results = self.process_batch(items)
+                assert len(results) == len(items), f'process_batch returned {len(results)} results for {len(items)} items'
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def close(self) -> None:
+        """
+        Processes what is still waiting and stops the batching thread
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
@@ -0,0 +1,110 @@
+import base64
+import hashlib
+import os
+from typing import List
+
+
+BLOB_REF_PREFIX = 'blob:sha256:'
+
+
+def is_blob_ref(image:str) -> bool:
+    return isinstance(image, str) and image.startswith(BLOB_REF_PREFIX)
+
+
+class BlobStore:
+    """
+    Content addressed storage for message images. Images are stored once per distinct content
+    under the sha256 of their bytes and messages only keep a 'blob:sha256:<hex>' reference.
+    """
+    def put_bytes(self, key:str, data:bytes) -> None:
+        raise NotImplementedError("Abstract method")
+
+    def get_bytes(self, key:str) -> bytes:
+        raise NotImplementedError("Abstract method")
+
+    def put(self, image_b64:str) -> str:
+        """
+        Stores a base64 encoded image and returns its reference
+        """
+        data = base64.b64decode(image_b64)
+        key = hashlib.sha256(data).hexdigest()
+        self.put_bytes(key, data)
+        return BLOB_REF_PREFIX + key
+
+    def get(self, ref:str) -> str:
+        """
+        Returns the base64 encoded image of a reference
+        """
+        data = self.get_bytes(ref[len(BLOB_REF_PREFIX):])
+        return base64.b64encode(data).decode('utf-8')
+
+    def resolve(self, images:List[str]) -> List[str]:
+        """
+        Replaces the references in a list of images with the base64 encoded images
+        """
+        if not images:
+            return images
+        return [self.get(img) if is_blob_ref(img) else img for img in images]
+
+    def externalize(self, message):
+        """
+        Returns a copy of TheMessage with its inline images stored in the blob store and replaced by references
+        """
+        images = message.contents.image
+        if not images or all(is_blob_ref(img) for img in images):
+            return message
+        refs = [img if is_blob_ref(img) else self.put(img) for img in images]
+        return message.copy(update={ 'contents': message.contents.copy(update={ 'image': refs }) })
+
+    def rehydrate(self, message):
+        """
+        Returns a copy of TheMessage with its image references replaced by the base64 encoded images
+        """
+        images = message.contents.image
+        if not images or not any(is_blob_ref(img) for img in images):
+            return message
+        return message.copy(update={ 'contents': message.contents.copy(update={ 'image': self.resolve(images) }) })
+
+
+class FileBlobStore(BlobStore):
+    """
+    Stores the blobs as files: <directory>/<first 2 hex chars>/<sha256 hex>
+    """
+    def __init__(self, directory:str):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def put_bytes(self, key:str, data:bytes) -> None:
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get_bytes(self, key:str) -> bytes:
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+
+class MongoBlobStore(BlobStore):
+    """
+    Stores the blobs in the 'basebot_blobs' collection of a MongoUtil database, one document per content hash
+    """
+    def __init__(self, mongo, collection:str='basebot_blobs'):
+        self.collection = mongo.db[collection]
+
+    def put_bytes(self, key:str, data:bytes) -> None:
+        self.collection.update_one({ '_id': key }, { '$setOnInsert': { 'data': data } }, upsert=True)
+
+    def get_bytes(self, key:str) -> bytes:
+        doc = self.collection.find_one({ '_id': key })
+        if doc is None:
+            raise KeyError(f'Missing blob {key}')
+        return bytes(doc['data'])
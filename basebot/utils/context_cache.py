@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class ContextCache:
+    """
+    Keeps the last `capacity` messages of the most recently active users in memory, newest last.
+    A user's buffer is filled from storage on the first read (load) and kept current by add(), so it
+    always holds the latest min(capacity, total) messages of the conversation and can answer any
+    history read of up to `capacity` messages. Users idle for idle_seconds, or beyond max_users, are evicted.
+    """
+    def __init__(self, capacity:int=20, max_users:int=1000, idle_seconds:float=3600):
+        self.capacity = capacity
+        self.max_users = max_users
+        self.idle_seconds = idle_seconds
+        self._users = OrderedDict() # user_id -> (messages, last_access), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self, now:float) -> None:
+        while self._users:
+            user_id, (_, last_access) = next(iter(self._users.items()))
+            if len(self._users) <= self.max_users and now - last_access < self.idle_seconds:
+                break
+            self._users.popitem(last=False)
+
+    def _merge(self, messages:list, new_messages:list) -> list:
+        by_id = { msg.message_id: msg for msg in messages }
+        for msg in new_messages:
+            by_id[msg.message_id] = msg
+        return sorted(by_id.values(), key=lambda msg: msg.timestamp)[-self.capacity:]
+
+    def add(self, user_id:str, message) -> None:
+        """
+        Write-through of a saved message, ignored for users whose buffer is not loaded
+        """
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return
+            self._users[user_id] = (self._merge(entry[0], [message]), entry[1])
+
+    def load(self, user_id:str, messages:list) -> None:
+        """
+        Fills the buffer of a user with the result of a storage read of `capacity` messages (in any order)
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            current = entry[0] if entry is not None else []
+            self._users[user_id] = (self._merge(current, messages), now)
+            self._users.move_to_end(user_id)
+            self._evict(now)
+
+    def get(self, user_id:str, limit:int) -> Optional[List]:
+        """
+        Returns the last `limit` messages of a user, most recent first, or None if they need to be read from storage
+        """
+        if limit > self.capacity:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._users.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._users[user_id] = (entry[0], now)
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return list(reversed(entry[0][-limit:]))
+
+    def discard(self, user_id:str) -> None:
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return { 'users': len(self._users), 'hits': self.hits, 'misses': self.misses }
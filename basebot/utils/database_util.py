@@ -1,23 +1,32 @@
-import os 
-import pymongo
-from pymongo import DESCENDING
-from bson import ObjectId
-from typing import Optional, List
-import json, time
+import bisect
+import hashlib
 import json
 import os
-from typing import Dict, List
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 from ..models.the_message import TheMessage
+from .file_lock import FileLock
 
 USER_ID = 'sender_id'
 TO_USER_ID = 'recipient_id'
 TS = 'timestamp'
 MESSAGE_ID = 'message_id'
 
+IMAGES = 'contents.image'
+
 SET = '$set'
 LESS_THAN = '$lt'
 CONTAINS = '$in'
+OR = '$or'
+DESCENDING = -1 # pymongo.DESCENDING
+
+# buffered MongoUtil writes failing with a network error are retried this many times, after 0.1s, 0.2s, 0.4s...
+MONGO_WRITE_RETRIES = 3
+MONGO_RETRY_BACKOFF = 0.1
 
 
 class DbUtil:
@@ -27,7 +36,11 @@ class DbUtil:
     def save_chat_message(self, bot:str, message:TheMessage) -> None:
         raise NotImplementedError("Abstract method")
 
-    def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None) -> List[TheMessage]:
+    def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None, include_images:bool=True) -> List[TheMessage]:
+        """
+        Returns the newest {limit} messages to or from the user older than before_ts, newest first.
+          include_images=False leaves contents.image empty for callers that only need the text.
+        """
         raise NotImplementedError("Abstract method")
     
     def clear_chat_history(self, bot:str, user_id:str) -> None:
@@ -35,35 +48,140 @@ class DbUtil:
     
     def rate_message(self, bot:str, message_id:str, rating:float) -> None:
         raise NotImplementedError("Abstract method")
-        
+
+    def close(self) -> None:
+        """
+        Releases any resources held by the util (open files, background threads). No-op by default.
+        """
+        pass
+
 
 class MongoUtil(DbUtil):
-    def __init__(self):
+    """
+    Stores the conversations in MongoDB, one collection per bot. Requires the MONGO_URI environment variable.
+
+    With buffered=True saves and feedback updates are queued and sent with unordered bulk_write calls
+    by a background thread once flush_size writes are pending or the oldest is flush_interval seconds old.
+    Reads merge in the not yet flushed messages so callers always see their own writes.
+    Writes are acknowledged before they reach MongoDB: batches failing with a network error are retried
+    MONGO_WRITE_RETRIES times with backoff, then they are lost, and so are the writes MongoDB rejects.
+    """
+    def __init__(self, buffered:bool=False, flush_size:int=100, flush_interval:float=0.05):
         super().__init__()
+        # imported here so bots that do not use MongoDB do not pay for pymongo at startup
+        import pymongo
         self.mongo = pymongo.MongoClient(os.environ['MONGO_URI'], retryWrites=False, connect=False)
-        pass
+        self._committer = None
+        self._unflushed: Dict[Tuple[str, str], Dict] = {} # (bot, message_id) -> message dict that is not in mongo yet
+        self._unflushed_lock = threading.Lock()
+        if buffered:
+            self._committer = _GroupCommitter(self._bulk_write, flush_size=flush_size, flush_interval=flush_interval)
     def rate_message(self, bot:str, message_id:str, rating:float) -> None:
+        if self._committer is not None:
+            self._committer.add(('rate', bot, message_id, rating))
+            return
         self.mongo.db[bot].update_one({MESSAGE_ID: message_id}, {SET: { 'feedback':rating }})
     def save_chat_message(self, bot:str, message:TheMessage) -> None:
+        if self._committer is not None:
+            msg_dict = message.dict()
+            with self._unflushed_lock:
+                self._unflushed[(bot, message.message_id)] = msg_dict
+            self._committer.add(('save', bot, msg_dict))
+            return
         self.mongo.db[bot].update_one({ MESSAGE_ID: message.message_id }, { SET: message.dict()}, upsert=True)
+    def _bulk_write(self, batch:List[Tuple]) -> None:
+        import pymongo
+        # the writes are unordered, so coalesce them per message: the last save wins and feedback is folded into it
+        updates = OrderedDict() # (bot, message_id) -> (fields to set, upsert)
+        for op in batch:
+            if op[0] == 'save':
+                _, bot, msg_dict = op
+                key = (bot, msg_dict[MESSAGE_ID])
+                fields = dict(msg_dict)
+                if key in updates and 'feedback' in updates[key][0]:
+                    fields['feedback'] = updates[key][0]['feedback']
+                updates[key] = (fields, True)
+            else:
+                _, bot, message_id, rating = op
+                key = (bot, message_id)
+                fields, upsert = updates.get(key, ({}, False))
+                fields['feedback'] = rating
+                updates[key] = (fields, upsert)
+        requests_by_bot = {}
+        for (bot, message_id), (fields, upsert) in updates.items():
+            requests_by_bot.setdefault(bot, []).append(pymongo.UpdateOne({ MESSAGE_ID: message_id }, { SET: fields }, upsert=upsert))
+        for bot, requests in requests_by_bot.items():
+            self._bulk_write_bot(bot, requests)
+        # also for the failed writes, reads must not show messages that are not stored
+        with self._unflushed_lock:
+            for op in batch:
+                if op[0] == 'save':
+                    key = (op[1], op[2][MESSAGE_ID])
+                    # keep it if it was saved again after this batch was taken
+                    if self._unflushed.get(key) is op[2]:
+                        del self._unflushed[key]
+    def _bulk_write_bot(self, bot:str, requests:List) -> None:
+        """
+        Sends the writes of a bot, retrying the whole batch on network errors (the updates are idempotent).
+          Writes rejected by MongoDB are not retried, they would fail again and hold up every later batch.
+        """
+        from pymongo.errors import AutoReconnect, BulkWriteError, NetworkTimeout, ServerSelectionTimeoutError
+        for attempt in range(MONGO_WRITE_RETRIES + 1):
+            try:
+                self.mongo.db[bot].bulk_write(requests, ordered=False)
+                return
+            except BulkWriteError as e:
+                # unordered: every write but the ones listed is stored
+                failed = e.details.get('writeErrors', [])
+                errors = '\n\t'.join(error.get('errmsg', '') for error in failed[:3])
+                print(f'WARNING: MongoUtil failed to write {len(failed)} of {len(requests)} buffered writes of {bot}, they are lost. Errors:\n\t{errors}')
+                return
+            except (AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError) as e:
+                if attempt == MONGO_WRITE_RETRIES:
+                    print(f'WARNING: MongoUtil failed to write {len(requests)} buffered writes of {bot} after {attempt + 1} attempts, they are lost. Exception:\n\t', e)
+                    return
+                time.sleep(MONGO_RETRY_BACKOFF * 2 ** attempt)
+            except Exception as e:
+                print(f'WARNING: MongoUtil failed to write {len(requests)} buffered writes of {bot}, they are lost. Exception:\n\t', e)
+                return
+    def flush(self) -> None:
+        if self._committer is not None:
+            self._committer.flush()
+    def close(self) -> None:
+        if self._committer is not None:
+            self._committer.close()
+            self._committer = None
     def clear_chat_history(self, bot: str, user_id: str):
+        self.flush()
         from_criteria = { USER_ID: user_id }
         to_criteria = { TO_USER_ID: user_id }
         self.mongo.db[bot].delete_many(from_criteria)
         self.mongo.db[bot].delete_many(to_criteria)
-    def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None) -> List[TheMessage]:
-        from_criteria = { USER_ID: user_id }
-        to_criteria = { TO_USER_ID: user_id }
+    def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None, include_images:bool=True) -> List[TheMessage]:
+        # one round trip: the server merges the sender_id_-1_timestamp_-1 and recipient_id_-1_timestamp_-1
+        #   index scans of the $or branches, sorts and limits, so only {limit} documents are sent and parsed
+        criteria = { OR: [ { USER_ID: user_id }, { TO_USER_ID: user_id } ] }
         if before_ts is not None:
-            from_criteria[TS] = { LESS_THAN: before_ts }
-            to_criteria[TS] = { LESS_THAN: before_ts }
-        messages = []
-        for msg_dict in self.mongo.db[bot].find(from_criteria).sort(TS, pymongo.DESCENDING).limit(limit):
-            messages.append(TheMessage.parse_obj(msg_dict))
-        for msg_dict in self.mongo.db[bot].find(to_criteria).sort(TS, pymongo.DESCENDING).limit(limit):
-            messages.append(TheMessage.parse_obj(msg_dict))
-        messages = sorted(messages, key=lambda m: m.timestamp, reverse=True)[:limit]
+            criteria[TS] = { LESS_THAN: before_ts }
+        projection = { '_id': False, 'feedback': False }
+        if not include_images:
+            projection[IMAGES] = False
+        cursor = self.mongo.db[bot].find(criteria, projection).sort(TS, DESCENDING).limit(limit)
+        messages = [TheMessage.parse_obj(msg_dict) for msg_dict in cursor]
+        if self._unflushed:
+            messages = self._merge_unflushed(messages, bot, user_id, limit, before_ts, include_images)
         return messages
+    def _merge_unflushed(self, messages:List[TheMessage], bot:str, user_id:str, limit:int, before_ts, include_images:bool) -> List[TheMessage]:
+        with self._unflushed_lock:
+            unflushed = [msg_dict for (msg_bot, _), msg_dict in self._unflushed.items()
+                         if msg_bot == bot and (msg_dict[USER_ID] == user_id or msg_dict[TO_USER_ID] == user_id)
+                         and (before_ts is None or msg_dict[TS] < before_ts)]
+        if not unflushed:
+            return messages
+        unflushed_ids = set(msg_dict[MESSAGE_ID] for msg_dict in unflushed)
+        messages = [msg for msg in messages if msg.message_id not in unflushed_ids]
+        messages += [_parse_message(msg_dict, include_images) for msg_dict in unflushed]
+        return sorted(messages, key=lambda m: m.timestamp, reverse=True)[:limit]
 
     def create_index(self, table_name, field_name):
         collection = self.mongo.db[table_name]
@@ -81,27 +199,238 @@ class MongoUtil(DbUtil):
             return
 
         # Create the index if it doesn't exist
-        result = collection.create_index([(field_name, DESCENDING), ("timestamp", DESCENDING)])
+        collection.create_index([(field_name, DESCENDING), ("timestamp", DESCENDING)])
         print("Index created successfully!")
 
 
 
 
 
+def _read_jsonl(path:str):
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # a torn last line from a crash mid-write
+                print(f'WARNING: skipping corrupt record in {path}')
+
+
+def _parse_message(msg:Dict, include_images:bool=True) -> TheMessage:
+    if not include_images and msg['contents'].get('image'):
+        msg = dict(msg, contents=dict(msg['contents'], image=[]))
+    return TheMessage.parse_obj(msg)
+
+
+class _Conversations:
+    """
+    The in-memory conversations of the local stores: user_id -> message list kept sorted by timestamp,
+    a parallel user_id -> timestamp list used to cut history pages with a binary search,
+    and a message_id -> (user_id, position) index.
+    """
+    def __init__(self, messages:Dict = None):
+        self.messages: Dict[str, List[Dict]] = messages if messages is not None else {}
+        self.timestamps: Dict[str, List[float]] = {}
+        self.index: Dict[str, Tuple[str, int]] = {}
+        for user_id, user_messages in self.messages.items():
+            user_messages.sort(key=lambda m: m['timestamp'])
+            self.timestamps[user_id] = [m['timestamp'] for m in user_messages]
+            self._reindex(user_id, 0)
+
+    def _reindex(self, user_id:str, start:int) -> None:
+        user_messages = self.messages[user_id]
+        for i in range(start, len(user_messages)):
+            self.index[user_messages[i]['message_id']] = (user_id, i)
+
+    def _insert(self, user_id:str, msg:Dict) -> None:
+        user_messages = self.messages.setdefault(user_id, [])
+        timestamps = self.timestamps.setdefault(user_id, [])
+        # messages nearly always arrive in order, so this is an append
+        i = bisect.bisect_right(timestamps, msg['timestamp'])
+        user_messages.insert(i, msg)
+        timestamps.insert(i, msg['timestamp'])
+        self._reindex(user_id, i)
+
+    def _remove(self, user_id:str, i:int) -> None:
+        msg = self.messages[user_id].pop(i)
+        self.timestamps[user_id].pop(i)
+        del self.index[msg['message_id']]
+        self._reindex(user_id, i)
+
+    def apply(self, record:Dict) -> None:
+        """
+        Applies a journal record ('save', 'rate' or 'clear'). Saving an existing message_id replaces it, same as MongoUtil's upsert.
+        """
+        op = record['op']
+        if op == 'save':
+            msg = record['message']
+            location = self.index.get(msg['message_id'])
+            if location is not None:
+                user_id, i = location
+                if self.timestamps[user_id][i] == msg['timestamp']:
+                    self.messages[user_id][i] = msg
+                    return
+                self._remove(user_id, i)
+            self._insert(record['user_id'], msg)
+        elif op == 'clear':
+            self.timestamps.pop(record['user_id'], None)
+            for msg in self.messages.pop(record['user_id'], []):
+                self.index.pop(msg['message_id'], None)
+        elif op == 'rate':
+            location = self.index.get(record['message_id'])
+            if location is not None:
+                user_id, i = location
+                self.messages[user_id][i]['feedback'] = record['rating']
+
+    def get(self, message_id:str) -> Optional[Dict]:
+        location = self.index.get(message_id)
+        if location is None:
+            return None
+        user_id, i = location
+        return self.messages[user_id][i]
+
+    def count(self, user_id:str) -> int:
+        return len(self.timestamps.get(user_id, []))
+
+    def page(self, user_id:str, limit=10, before_ts=None, descending:bool=True) -> List[Dict]:
+        """
+        Returns the newest {limit} messages of the user older than before_ts in O(log n + limit)
+        """
+        timestamps = self.timestamps.get(user_id)
+        if not timestamps:
+            return []
+        end = len(timestamps) if before_ts is None else bisect.bisect_left(timestamps, before_ts)
+        start = max(0, end - limit)
+        messages = self.messages[user_id][start:end]
+        if descending:
+            messages.reverse()
+        return messages
+
+
+class _GroupCommitter:
+    """
+    Write-behind buffer of the local stores. Writes are queued by add() and handed in order to commit(batch)
+    by a background thread once flush_size writes are pending or the oldest pending write is
+    flush_interval seconds old, which bounds how many acknowledged writes a crash can lose.
+    """
+    def __init__(self, commit, flush_size:int=256, flush_interval:float=0.05):
+        self.commit = commit
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._cond = threading.Condition()
+        self._commit_lock = threading.Lock() # keeps the batches in order
+        self._stopped = False
+        self._thread = threading.Thread(target=self._flush_runner, daemon=True)
+        self._thread.start()
+
+    def add(self, item) -> None:
+        with self._cond:
+            self._pending.append(item)
+            if len(self._pending) == 1 or len(self._pending) >= self.flush_size:
+                self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self) -> None:
+        with self._commit_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if batch:
+                self.commit(batch)
+
+    def _flush_runner(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._pending) < self.flush_size and not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            try:
+                self.flush()
+            except Exception as e:
+                print('Failed to flush buffered writes with exception:\n\t', e)
+
+    def close(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.flush()
+
+
+def _single_process_lock(path:str, name:str) -> FileLock:
+    """
+    Takes a lock on the files of a store that only works within one process and warns if another process already uses them
+    """
+    lock = FileLock(path)
+    if not lock.try_acquire():
+        print(f'WARNING: {name} is already in use by another process or store (lock {path}). It keeps its data in memory and is not safe\n\t'
+              'across processes, run a single worker or use SqliteUtil or MongoUtil')
+    return lock
+
+
+def _fsync(f) -> None:
+    f.flush()
+    os.fsync(f.fileno())
+
+
 class JsonUtil(DbUtil):
-    def __init__(self, bot_id:str, json_directory:str):
+    """
+    Stores the conversations of a bot in a single JSON file: <json_directory>/<bot_id>_messages.json
+
+    By default every write rewrites the whole file. With journaled=True writes are instead appended
+    to <bot_id>_messages.journal.jsonl (one JSON record per line) so the cost of a write does not depend
+    on the size of the history. The journal is replayed on startup and folded into the JSON snapshot
+    by a background thread once it holds compact_every records.
+
+    With write_behind=True journal records are acknowledged as soon as they are applied in memory and
+    are appended and fsynced in batches by a background thread (see flush_size and flush_interval).
+    """
+    def __init__(self, bot_id:str, json_directory:str, journaled:bool=False, compact_every:int=1000,
+                 write_behind:bool=False, flush_size:int=256, flush_interval:float=0.05):
         super().__init__()
-        self.messages: Dict[List[Dict]] = {} # Dictionary user_id -> message list. Each message is a dictionary version of TheMessage
+        self.messages: Dict[List[Dict]] = {} # Dictionary user_id -> message list sorted by timestamp. Each message is a dictionary version of TheMessage
+        self.conversations = _Conversations(self.messages)
         self.bot_id = bot_id
         if not os.path.exists(json_directory):
             os.makedirs(json_directory)
         filename = bot_id + '_messages.json'
         self.json_name = os.path.join(json_directory, filename)
+        self.journal_name = os.path.join(json_directory, bot_id + '_messages.journal.jsonl')
+        self.compacting_name = self.journal_name + '.compacting'
+        self.journaled = journaled
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        self._journal_entries = 0
+        self._compact_event = threading.Event()
+        self._stopped = False
+        self._compactor = None
+        self._committer = None
+        if write_behind and not journaled:
+            raise ValueError('JsonUtil write_behind requires journaled=True')
+        self._process_lock = _single_process_lock(self.json_name + '.lock', f'JsonUtil {self.json_name}')
         self.load_messages()
+        if self.journaled:
+            self._journal = open(self.journal_name, 'a')
+            self._compactor = threading.Thread(target=self._compaction_runner, daemon=True)
+            self._compactor.start()
+        if write_behind:
+            self._committer = _GroupCommitter(self._commit_journal, flush_size=flush_size, flush_interval=flush_interval)
 
     def save_messages(self):
-        with open(self.json_name, 'w') as f:
-            json.dump(self.messages, f)
+        self._write_snapshot(self.messages)
 
     def load_messages(self):
         if not os.path.exists(self.json_name):
@@ -110,58 +439,407 @@ class JsonUtil(DbUtil):
                 json.dump(data, f)
         with open(self.json_name, 'r') as f:
             self.messages = json.load(f)
+        self.conversations = _Conversations(self.messages)
+        # replay whatever was journaled since the last snapshot, then fold it in right away
+        replayed = False
+        for journal_name in [self.compacting_name, self.journal_name]:
+            if os.path.exists(journal_name):
+                for record in _read_jsonl(journal_name):
+                    self.conversations.apply(record)
+                replayed = True
+        if replayed:
+            self.save_messages()
+            for journal_name in [self.compacting_name, self.journal_name]:
+                if os.path.exists(journal_name):
+                    os.remove(journal_name)
+
+    def _write_snapshot(self, messages:Dict):
+        tmp_name = self.json_name + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump(messages, f)
+        os.replace(tmp_name, self.json_name)
+
+    def _write(self, record:Dict) -> None:
+        """
+        Applies the record to the in-memory messages and persists it
+        """
+        with self._lock:
+            self.conversations.apply(record)
+            if not self.journaled:
+                self.save_messages()
+                return
+            line = json.dumps(record) + '\n'
+            if self._committer is not None:
+                self._committer.add(line)
+            else:
+                with self._journal_lock:
+                    self._journal.write(line)
+                    self._journal.flush()
+            self._journal_entries += 1
+            if self._journal_entries >= self.compact_every:
+                self._compact_event.set()
+
+    def _commit_journal(self, lines:List[str]) -> None:
+        with self._journal_lock:
+            self._journal.write(''.join(lines))
+            _fsync(self._journal)
+
+    def compact(self) -> None:
+        """
+        Folds the journal into the JSON snapshot. Only the journal rotation happens under the write lock,
+          the snapshot is rebuilt from disk so writers are never blocked on serializing the history.
+        """
+        if not self.journaled:
+            return
+        with self._compact_lock:
+            # buffered records that are not flushed yet are later than everything in the rotated journal
+            with self._lock, self._journal_lock:
+                if self._journal_entries == 0:
+                    return
+                self._journal.close()
+                os.replace(self.journal_name, self.compacting_name)
+                self._journal = open(self.journal_name, 'a')
+                self._journal_entries = 0
+            with open(self.json_name, 'r') as f:
+                snapshot = json.load(f)
+            snapshot = _Conversations(snapshot)
+            for record in _read_jsonl(self.compacting_name):
+                snapshot.apply(record)
+            self._write_snapshot(snapshot.messages)
+            os.remove(self.compacting_name)
+
+    def _compaction_runner(self):
+        while not self._stopped:
+            self._compact_event.wait()
+            self._compact_event.clear()
+            if self._stopped:
+                break
+            try:
+                self.compact()
+            except Exception as e:
+                print(f'{self.bot_id} failed to compact message journal with exception:\n\t', e)
+
+    def close(self) -> None:
+        if self._compactor is not None:
+            self._stopped = True
+            self._compact_event.set()
+            self._compactor.join()
+            self._compactor = None
+        if self._committer is not None:
+            self._committer.close()
+            self._committer = None
+        with self._lock, self._journal_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+        self._process_lock.release()
+
     def clear_chat_history(self, bot: str, user_id: str) -> None:
-        del self.messages[user_id]
-        self.save_messages()
+        self._write({ 'op': 'clear', 'user_id': user_id })
     def get_message_history(self,
                             user_id:str,
                             limit=10,
                             before_ts=None,
                             descending:bool=True) -> List[Dict]:
-        filtered_messages = []
-        if user_id not in self.messages:
-            self.messages[user_id] = []
-        n = 0
-        for message in reversed(self.messages[user_id]):
-            if (message['sender_id'] == user_id or message['recipient_id'] == user_id):
-                if (before_ts is None or message['timestamp'] < before_ts):
-                    filtered_messages.append(message)
-                    n += 1
-                    if n >= limit:
-                        break
-        if (descending):
-            filtered_messages = sorted(filtered_messages,
-                                       key=lambda k: k['timestamp'],
-                                       reverse=True)
-        else:
-            filtered_messages = sorted(filtered_messages, key=lambda k: k['timestamp'])
-        return filtered_messages[:limit]
+        return self.conversations.page(user_id, limit, before_ts, descending)
     
-    def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None) -> List[TheMessage]:
+    def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None, include_images:bool=True) -> List[TheMessage]:
         o = self.get_message_history(user_id, limit, before_ts)
-        return [TheMessage.parse_obj(m) for m in o]
+        return [_parse_message(m, include_images) for m in o]
+
+    def get_message(self, message_id:str) -> Optional[Dict]:
+        """
+        Returns the message with the given message_id, or None. O(1) through the message_id index.
+        """
+        return self.conversations.get(message_id)
 
     def _save_chat_message(self, bot_name, message: Dict):
         if message['sender_id'] == bot_name:
             user_id = message['recipient_id']
         else:
             user_id = message['sender_id']
-        if user_id not in self.messages:
-            self.messages[user_id] = []
-        self.messages[user_id].append(message)
-        self.save_messages()
+        self._write({ 'op': 'save', 'user_id': user_id, 'message': message })
 
     def save_chat_message(self, name:str, message:TheMessage) -> None:
         self._save_chat_message(name, message.dict())
 
     def rate_message(self, bot: str, message_id: str, rating: float) -> None:
-        found = False
-        for userid, messages in self.messages.items():
-            for msg in messages:
-                if msg['message_id'] == message_id:
-                    msg['feedback'] = rating
-                    found = True
-                    break
-            if found:
-                break
-        self.save_messages()
\ No newline at end of file
+        if self.conversations.get(message_id) is None:
+            return
+        self._write({ 'op': 'rate', 'message_id': message_id, 'rating': rating })
+
+
+
+class ShardedJsonUtil(DbUtil):
+    """
+    Stores every user's conversation in its own append-only file: <json_directory>/<bot_id>/<sha1(user_id)>.jsonl
+
+    A user's history is only read from disk the first time it is needed, and the least recently used
+    conversations are evicted from memory once more than max_users users or max_messages messages
+    are resident. Memory and startup time depend on the number of active users, not all-time traffic.
+    Which user a message_id belongs to is kept in an on-disk SQLite index (message_index.sqlite)
+    so feedback never has to scan the conversations.
+
+    With write_behind=True the appends to the user files are acknowledged from memory and written
+    and fsynced in batches by a background thread (see flush_size and flush_interval).
+    """
+    def __init__(self, bot_id:str, json_directory:str, max_users:int=1000, max_messages:int=100_000,
+                 write_behind:bool=False, flush_size:int=256, flush_interval:float=0.05):
+        super().__init__()
+        self.bot_id = bot_id
+        self.directory = os.path.join(json_directory, bot_id)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.max_users = max_users
+        self.max_messages = max_messages
+        self.conversations: OrderedDict = OrderedDict() # user_id -> _Conversations of the resident users, least recently used first
+        self._resident_messages = 0
+        self._lock = threading.RLock()
+        self._process_lock = _single_process_lock(os.path.join(self.directory, 'store.lock'), f'ShardedJsonUtil {self.directory}')
+        index_name = os.path.join(self.directory, 'message_index.sqlite')
+        rebuild_index = not os.path.exists(index_name)
+        self._index_db = sqlite3.connect(index_name, check_same_thread=False, isolation_level=None)
+        self._index_db.execute('PRAGMA journal_mode=WAL')
+        self._index_db.execute('PRAGMA synchronous=NORMAL')
+        self._index_db.execute('CREATE TABLE IF NOT EXISTS message_index (message_id TEXT PRIMARY KEY, user_id TEXT NOT NULL)')
+        self._index_db.execute('CREATE INDEX IF NOT EXISTS message_index_user_id ON message_index (user_id)')
+        if rebuild_index:
+            self._rebuild_index()
+        self._committer = None
+        if write_behind:
+            self._committer = _GroupCommitter(self._commit_records, flush_size=flush_size, flush_interval=flush_interval)
+
+    def _rebuild_index(self) -> None:
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.jsonl'):
+                continue
+            rows = [(record['message']['message_id'], record['user_id'])
+                    for record in _read_jsonl(os.path.join(self.directory, filename)) if record['op'] == 'save']
+            self._index_db.executemany('INSERT OR REPLACE INTO message_index VALUES (?, ?)', rows)
+
+    def _user_filename(self, user_id:str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(user_id.encode('utf-8')).hexdigest() + '.jsonl')
+
+    def _load_user(self, user_id:str) -> _Conversations:
+        """
+        Returns the resident conversation of the user, reading it from disk on a miss
+        """
+        if user_id in self.conversations:
+            self.conversations.move_to_end(user_id)
+            return self.conversations[user_id]
+        if self._committer is not None:
+            # the user may have been evicted with writes still buffered, or in a batch that is being committed:
+            #   flush() waits for that batch, and no batch can start while we hold self._lock and read or rewrite the file
+            self._committer.flush()
+        filename = self._user_filename(user_id)
+        conversation = _Conversations()
+        n_records = 0
+        if os.path.exists(filename):
+            for record in _read_jsonl(filename):
+                conversation.apply(record)
+                n_records += 1
+        if n_records > conversation.count(user_id):
+            # fold the feedback updates and re-saves into the saved messages
+            self._rewrite_user(user_id, conversation.messages.get(user_id, []))
+        self.conversations[user_id] = conversation
+        self._resident_messages += conversation.count(user_id)
+        self._evict()
+        return conversation
+
+    def _rewrite_user(self, user_id:str, user_messages:List[Dict]) -> None:
+        filename = self._user_filename(user_id)
+        tmp_name = filename + '.tmp'
+        with open(tmp_name, 'w') as f:
+            for msg in user_messages:
+                f.write(json.dumps({ 'op': 'save', 'user_id': user_id, 'message': msg }) + '\n')
+        os.replace(tmp_name, filename)
+
+    def _write(self, user_id:str, record:Dict) -> None:
+        """
+        Applies the record to the resident conversation of the user and appends it to the user's file
+        """
+        conversation = self._load_user(user_id)
+        n = conversation.count(user_id)
+        conversation.apply(record)
+        self._resident_messages += conversation.count(user_id) - n
+        self._append(user_id, record)
+        self._evict()
+
+    def _append(self, user_id:str, record:Dict) -> None:
+        line = json.dumps(record) + '\n'
+        if self._committer is not None:
+            self._committer.add((user_id, line))
+        else:
+            with open(self._user_filename(user_id), 'a') as f:
+                f.write(line)
+
+    def _commit_records(self, batch:List[Tuple[str, str]]) -> None:
+        lines_by_user = OrderedDict()
+        for user_id, line in batch:
+            lines_by_user.setdefault(user_id, []).append(line)
+        for user_id, lines in lines_by_user.items():
+            with open(self._user_filename(user_id), 'a') as f:
+                f.write(''.join(lines))
+                _fsync(f)
+
+    def _evict(self) -> None:
+        # never evict the most recently used user, it is the one being served
+        while len(self.conversations) > 1 and (len(self.conversations) > self.max_users or self._resident_messages > self.max_messages):
+            user_id, conversation = self.conversations.popitem(last=False)
+            self._resident_messages -= conversation.count(user_id)
+
+    def _find_user(self, message_id:str) -> Optional[str]:
+        row = self._index_db.execute('SELECT user_id FROM message_index WHERE message_id = ?', (message_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_message(self, message_id:str) -> Optional[Dict]:
+        """
+        Returns the message with the given message_id, or None
+        """
+        with self._lock:
+            user_id = self._find_user(message_id)
+            if user_id is None:
+                return None
+            return self._load_user(user_id).get(message_id)
+
+    def save_chat_message(self, bot:str, message:TheMessage) -> None:
+        message = message.dict()
+        if message['sender_id'] == bot:
+            user_id = message['recipient_id']
+        else:
+            user_id = message['sender_id']
+        with self._lock:
+            self._write(user_id, { 'op': 'save', 'user_id': user_id, 'message': message })
+            self._index_db.execute('INSERT OR REPLACE INTO message_index VALUES (?, ?)', (message['message_id'], user_id))
+
+    def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None, include_images:bool=True) -> List[TheMessage]:
+        with self._lock:
+            o = self._load_user(user_id).page(user_id, limit, before_ts)
+        return [_parse_message(m, include_images) for m in o]
+
+    def clear_chat_history(self, bot:str, user_id:str) -> None:
+        with self._lock:
+            conversation = self.conversations.pop(user_id, None)
+            if conversation is not None:
+                self._resident_messages -= conversation.count(user_id)
+            if self._committer is not None:
+                self._committer.flush()
+            filename = self._user_filename(user_id)
+            if os.path.exists(filename):
+                os.remove(filename)
+            self._index_db.execute('DELETE FROM message_index WHERE user_id = ?', (user_id,))
+
+    def rate_message(self, bot:str, message_id:str, rating:float) -> None:
+        with self._lock:
+            user_id = self._find_user(message_id)
+            if user_id is None:
+                return
+            record = { 'op': 'rate', 'user_id': user_id, 'message_id': message_id, 'rating': rating }
+            if user_id in self.conversations:
+                self._write(user_id, record)
+            else:
+                # no need to read the user's file, the feedback is folded into it on the next load
+                self._append(user_id, record)
+
+    def close(self) -> None:
+        if self._committer is not None:
+            self._committer.close()
+            self._committer = None
+        with self._lock:
+            self._index_db.close()
+        self._process_lock.release()
+
+
+
+class SqliteUtil(DbUtil):
+    """
+    Stores the conversations in an embedded SQLite database file, no server needed.
+
+    The database runs in WAL mode so readers never block on the writer, history pages are served by
+    (bot, sender_id, timestamp) and (bot, recipient_id, timestamp) indexes with before_ts keyset
+    pagination, and rate_message looks messages up through the (bot, message_id) primary key.
+    Every thread gets its own connection.
+    """
+    def __init__(self, db_path:str):
+        super().__init__()
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        conn = self._connection()
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+                bot TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                sender_id TEXT NOT NULL,
+                recipient_id TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                feedback REAL,
+                message TEXT NOT NULL,
+                PRIMARY KEY (bot, message_id)
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS messages_sender_ts ON messages (bot, sender_id, timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS messages_recipient_ts ON messages (bot, recipient_id, timestamp)')
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def save_chat_message(self, bot:str, message:TheMessage) -> None:
+        conn = self._connection()
+        with conn:
+            # keep the feedback of a message that is saved again
+            conn.execute('''INSERT INTO messages (bot, message_id, sender_id, recipient_id, timestamp, message)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (bot, message_id) DO UPDATE SET
+                                sender_id = excluded.sender_id, recipient_id = excluded.recipient_id,
+                                timestamp = excluded.timestamp, message = excluded.message''',
+                         (bot, message.message_id, message.sender_id, message.recipient_id, message.timestamp, message.json()))
+
+    def get_chat_messages(self, bot:str, user_id:str, limit:int=5, before_ts=None, include_images:bool=True) -> List[TheMessage]:
+        # each branch is a range scan on its (bot, *_id, timestamp) index, newest first
+        ts_criteria = ''
+        params = [bot, user_id]
+        if before_ts is not None:
+            ts_criteria = ' AND timestamp < ?'
+            params.append(before_ts)
+        params.append(limit)
+        query = f'''SELECT message FROM (
+                        SELECT * FROM (SELECT message, timestamp FROM messages WHERE bot = ? AND sender_id = ?{ts_criteria}
+                                       ORDER BY timestamp DESC LIMIT ?)
+                        UNION
+                        SELECT * FROM (SELECT message, timestamp FROM messages WHERE bot = ? AND recipient_id = ?{ts_criteria}
+                                       ORDER BY timestamp DESC LIMIT ?)
+                     ) ORDER BY timestamp DESC LIMIT ?'''
+        rows = self._connection().execute(query, params + params + [limit]).fetchall()
+        return [_parse_message(json.loads(row[0]), include_images) for row in rows]
+
+    def clear_chat_history(self, bot:str, user_id:str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM messages WHERE bot = ? AND sender_id = ?', (bot, user_id))
+            conn.execute('DELETE FROM messages WHERE bot = ? AND recipient_id = ?', (bot, user_id))
+
+    def rate_message(self, bot:str, message_id:str, rating:float) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute('UPDATE messages SET feedback = ? WHERE bot = ? AND message_id = ?', (rating, bot, message_id))
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
@@ -0,0 +1,50 @@
+import os
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+
+class FileLock:
+    """
+    Non blocking exclusive lock (flock) on a file, shared by all the processes of a machine.
+    The OS releases it when the process holding it exits, crashes included, so another process can take over.
+    Without fcntl (Windows) every process gets the lock.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None or fcntl is None
+
+    def try_acquire(self) -> bool:
+        """
+        Returns True if this process holds the lock, acquiring it if it is free
+        """
+        if self._file is not None or fcntl is None:
+            return True
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        f = open(self.path, 'a+')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        # the pid of the holder, for debugging
+        f.truncate(0)
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self) -> None:
+        if self._file is None:
+            return
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
@@ -1,12 +1,19 @@
-from PIL import Image
-import numpy as np 
-import io, base64
+import io, base64, time
+from typing import TYPE_CHECKING
+
+from . import metrics
+
+# PIL and numpy are imported on the first image operation, text-only bots never load them
+if TYPE_CHECKING:
+    from PIL import Image
 
 
 
 
 def resize_frame_with_aspect_ratio(im, max_pixels):
-    im = Image.fromarray(im)
+    from PIL import Image as PILImage
+    import numpy as np
+    im = PILImage.fromarray(im)
     width = im.width
     height = im.height
     pixels = width*height
@@ -21,7 +28,17 @@ def resize_frame_with_aspect_ratio(im, max_pixels):
     return np.array(im)
 
 
-def img_to_b64_string(img: Image) -> str:
+def img_to_b64_string(img: 'Image.Image') -> str:
+    if metrics.ACTIVE is None:
+        return _img_to_b64_string(img)
+    start = time.perf_counter()
+    try:
+        return _img_to_b64_string(img)
+    finally:
+        metrics.ACTIVE.image_duration.observe(('encode',), time.perf_counter() - start)
+
+
+def _img_to_b64_string(img: 'Image.Image') -> str:
     im_file = io.BytesIO()
     img.save(im_file, format="JPEG")
     im_bytes = im_file.getvalue()  
@@ -30,14 +47,25 @@ def img_to_b64_string(img: Image) -> str:
     return im_b64
 
 
-def b64_string_to_img(im_b64: str) -> Image:
+def b64_string_to_img(im_b64: str) -> 'Image.Image':
+    if metrics.ACTIVE is None:
+        return _b64_string_to_img(im_b64)
+    start = time.perf_counter()
+    try:
+        return _b64_string_to_img(im_b64)
+    finally:
+        metrics.ACTIVE.image_duration.observe(('decode',), time.perf_counter() - start)
+
+
+def _b64_string_to_img(im_b64: str) -> 'Image.Image':
+    from PIL import Image as PILImage
     im_bytes = base64.b64decode(im_b64)  
     im_file = io.BytesIO(im_bytes)  
-    img2 = Image.open(im_file)   
+    img2 = PILImage.open(im_file)   
     return img2
 
 
-def shave_image(img:Image, vertical:bool, percent:int, verbose:bool=True) -> Image:
+def shave_image(img:'Image.Image', vertical:bool, percent:int, verbose:bool=True) -> 'Image.Image':
     left = 0 
     upper = 0
     right = img.width 
@@ -62,6 +90,7 @@ def shave_image(img:Image, vertical:bool, percent:int, verbose:bool=True) -> Ima
 
 if __name__ == '__main__':
     import argparse
+    from PIL import Image as PILImage
     parser = argparse.ArgumentParser()
     parser.add_argument('-p','--path', type=str, help='Path to image file' )
     parser.add_argument('-o','--out', type=str, required=False, help='Path to new image file' )
@@ -69,7 +98,7 @@ if __name__ == '__main__':
     parser.add_argument('--horizontal', action='store_true')
     parser.add_argument('--pct', type=int, help='Percent to trim using center crop : (0, 100)')
     args = parser.parse_args()
-    img = Image.open(args.path)
+    img = PILImage.open(args.path)
     
     assert args.vertical or args.horizontal, 'Must pass either --horizontal or --vertical'
     img = shave_image(img, args.vertical, args.pct)
@@ -0,0 +1,144 @@
+import functools
+import inspect
+import threading
+import time
+from typing import Callable, Tuple
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_str(names:Tuple[str], values:Tuple[str], le:str=None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name:str, help:str, labelnames:Tuple[str]):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels:Tuple[str], amount:float=1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_label_str(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name:str, help:str, labelnames:Tuple[str], buckets:Tuple[float]=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {} # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, labels:Tuple[str], value:float) -> None:
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            values[-2] += value
+            values[-1] += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, values in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, values):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_label_str(self.labelnames, labels, le=bound)} {cumulative}')
+                lines.append(f'{self.name}_bucket{_label_str(self.labelnames, labels, le="+Inf")} {values[-1]}')
+                lines.append(f'{self.name}_sum{_label_str(self.labelnames, labels)} {values[-2]}')
+                lines.append(f'{self.name}_count{_label_str(self.labelnames, labels)} {values[-1]}')
+        return lines
+
+
+class Metrics:
+    """
+    The metrics of the app in the Prometheus text format, served at /metrics by BaseBot.start_app(..., metrics=True)
+    """
+    def __init__(self):
+        self.requests = Counter('basebot_requests_total', 'HTTP requests by bot, endpoint and status code', ('bot', 'endpoint', 'status'))
+        self.request_duration = Histogram('basebot_request_duration_seconds', 'HTTP request latency by bot and endpoint', ('bot', 'endpoint'))
+        self.phase_duration = Histogram('basebot_phase_duration_seconds', 'Time spent in each step of /respond by bot', ('bot', 'phase'))
+        self.storage_duration = Histogram('basebot_storage_duration_seconds', 'Storage backend calls by bot, backend and operation', ('bot', 'backend', 'operation'))
+        self.image_duration = Histogram('basebot_image_duration_seconds', 'Image encoding and decoding', ('operation',))
+
+    def render(self) -> str:
+        lines = []
+        for metric in [self.requests, self.request_duration, self.phase_duration, self.storage_duration, self.image_duration]:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# the metrics of the running app, None while they are disabled
+ACTIVE: Metrics = None
+
+
+def enable_metrics() -> Metrics:
+    global ACTIVE
+    if ACTIVE is None:
+        ACTIVE = Metrics()
+    return ACTIVE
+
+
+def timed(func:Callable, histogram:Histogram, labels:Tuple[str]) -> Callable:
+    """
+    Wraps func to observe its duration in histogram. Coroutine functions and (async) generator functions
+      keep their kind, generators are timed until they are exhausted.
+    """
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                async for item in func(*args, **kwargs):
+                    yield item
+            finally:
+                histogram.observe(labels, time.perf_counter() - start)
+    elif inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(labels, time.perf_counter() - start)
+    elif inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                yield from func(*args, **kwargs)
+            finally:
+                histogram.observe(labels, time.perf_counter() - start)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(labels, time.perf_counter() - start)
+    return wrapper
@@ -0,0 +1,163 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import List
+
+
+class StackSampler:
+    """
+    Samples the stacks of registered threads every `interval` seconds from a single background thread,
+    which only runs while at least one thread is registered. The cost per sample does not depend on what the
+    sampled code does, so the overhead is bounded by the sampling rate.
+    start() returns a handle per sampled request. Requests sharing a thread, like the coroutines of an event loop,
+    pass the frame of their request: a sample only counts for the requests whose frame is on the sampled stack.
+    """
+    def __init__(self, interval:float=0.005):
+        self.interval = interval
+        self._samples = {} # handle -> (thread id, frame or None, Counter of folded stacks)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self, thread_id:int, frame=None) -> object:
+        handle = object()
+        with self._cond:
+            self._samples[handle] = (thread_id, frame, Counter())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample_runner, name='basebot-profiler', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return handle
+
+    def stop(self, handle:object) -> Counter:
+        with self._cond:
+            _, _, samples = self._samples.pop(handle, (None, None, Counter()))
+            return samples
+
+    def _sample_runner(self) -> None:
+        while True:
+            with self._cond:
+                while not self._samples:
+                    self._cond.wait()
+                sampled = [(handle, thread_id, frame) for handle, (thread_id, frame, _) in self._samples.items()]
+            stacks = _sample_stacks(sampled)
+            del sampled
+            with self._cond:
+                for handle, stack in stacks.items():
+                    if handle in self._samples:
+                        self._samples[handle][2][stack] += 1
+            time.sleep(self.interval)
+
+
+def _sample_stacks(sampled) -> dict:
+    """
+    The folded stack of each (handle, thread id, frame) whose thread is running frame, or any stack when frame is None
+    """
+    frames = sys._current_frames()
+    stacks = {}
+    for handle, thread_id, frame in sampled:
+        top = frames.get(thread_id)
+        if top is not None and (frame is None or _on_stack(frame, top)):
+            stacks[handle] = _fold(top)
+    return stacks
+
+
+def _on_stack(frame, top) -> bool:
+    """
+    Whether frame is running, i.e. is top or one of its callers
+    """
+    while top is not None:
+        if top is frame:
+            return True
+        top = top.f_back
+    return False
+
+
+def _fold(frame) -> str:
+    """
+    The stack of a frame in the folded format of flame graph tools: outermost;...;innermost
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class RequestProfiler:
+    """
+    Profiles every Nth request (every) and/or keeps the profile of any request slower than slower_than seconds.
+    Profiles are written to <directory>/<unix time>_<message_id>_<duration ms>ms.folded as folded stacks
+    ('frame;frame;frame <samples>' per line, for flamegraph.pl or speedscope), keeping the max_profiles most recent.
+    """
+    def __init__(self, directory:str, every:int=None, slower_than:float=None, interval:float=0.005, max_profiles:int=100):
+        assert every or slower_than, 'RequestProfiler needs every or slower_than'
+        self.directory = directory
+        self.every = every
+        self.slower_than = slower_than
+        self.max_profiles = max_profiles
+        self.sampler = StackSampler(interval)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _nth(self) -> bool:
+        if not self.every:
+            return False
+        with self._lock:
+            self._count += 1
+            return self._count % self.every == 0
+
+    @contextmanager
+    def profile(self, message_id:str, frame=None):
+        """
+        Samples the current thread for the duration of the block if this request is profiled.
+          With the frame of the request, e.g. the coroutine of an async request, only the samples taken while it runs are kept.
+        """
+        nth = self._nth()
+        if not nth and self.slower_than is None:
+            yield
+            return
+        start = time.perf_counter()
+        handle = self.sampler.start(threading.get_ident(), frame)
+        try:
+            yield
+        finally:
+            samples = self.sampler.stop(handle)
+            duration = time.perf_counter() - start
+            if nth or (self.slower_than is not None and duration > self.slower_than):
+                try:
+                    self._save(message_id, duration, samples)
+                except Exception as e:
+                    print(f'Failed to save the profile of message {message_id} with exception:\n\t', e)
+
+    def _save(self, message_id:str, duration:float, samples:Counter) -> None:
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        safe_id = re.sub(r'[^A-Za-z0-9-]', '_', message_id)
+        path = os.path.join(self.directory, f'{int(time.time())}_{safe_id}_{int(duration * 1000)}ms.folded')
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        for name in self.list()[self.max_profiles:]:
+            os.remove(os.path.join(self.directory, name))
+
+    def list(self) -> List[str]:
+        """
+        Names of the saved profiles, most recent first
+        """
+        if not os.path.exists(self.directory):
+            return []
+        names = [name for name in os.listdir(self.directory) if name.endswith('.folded')]
+        return sorted(names, key=lambda name: os.path.getmtime(os.path.join(self.directory, name)), reverse=True)
+
+    def path(self, name:str) -> str:
+        """
+        Path of a saved profile, None if there is no such profile
+        """
+        if name not in self.list():
+            return None
+        return os.path.join(self.directory, name)
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Hashable, Optional, Tuple
+
+
+class ReplyTable:
+    """
+    Remembers the replies of recent requests by key so that retries of a request get the same reply
+    instead of running it again. claim(key) returns (future, owner): the owner runs the request and
+    reports the outcome with finish(), everyone else waits on the future. Finished replies are kept
+    for ttl seconds, at most max_entries of them totalling at most max_bytes (as reported to finish()).
+    Failed requests are forgotten so they can be retried, and so are requests still unfinished after ttl
+    seconds, in case their owner never reports back. finish(..., keep=False) answers the waiting retries
+    but forgets the request too, for replies that would be different next time (e.g. a rejection).
+    """
+    def __init__(self, max_entries:int=10000, ttl:float=600, max_bytes:int=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._in_flight = OrderedDict() # key -> (Future, expires_at), oldest first
+        self._finished = OrderedDict() # key -> (Future, expires_at, size), oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def _evict(self, now:float) -> None:
+        while self._finished:
+            key, (_, expires_at, size) = next(iter(self._finished.items()))
+            if expires_at > now and len(self._finished) <= self.max_entries and (self.max_bytes is None or self._bytes <= self.max_bytes):
+                break
+            self._finished.popitem(last=False)
+            self._bytes -= size
+        while self._in_flight:
+            key, (_, expires_at) = next(iter(self._in_flight.items()))
+            if expires_at > now:
+                break
+            self._in_flight.popitem(last=False)
+
+    def get(self, key:Hashable) -> Optional[Future]:
+        """
+        Returns the future of a request that is running or finished recently, None otherwise
+        """
+        with self._lock:
+            self._evict(time.monotonic())
+            if key in self._in_flight:
+                self.hits += 1
+                return self._in_flight[key][0]
+            if key in self._finished:
+                self.hits += 1
+                return self._finished[key][0]
+            return None
+
+    def claim(self, key:Hashable) -> Tuple[Future, bool]:
+        with self._lock:
+            now = time.monotonic()
+            self._evict(now)
+            if key in self._in_flight:
+                self.hits += 1
+                return self._in_flight[key][0], False
+            if key in self._finished:
+                self.hits += 1
+                return self._finished[key][0], False
+            future = Future()
+            self._in_flight[key] = (future, now + self.ttl)
+            return future, True
+
+    def finish(self, key:Hashable, result=None, exception:BaseException=None, size:int=0, keep:bool=True) -> None:
+        """
+        Called by the owner of key with the reply and its approximate size in bytes, or with the exception the request failed with.
+          Does nothing if key is no longer in flight, e.g. when it already finished.
+        """
+        with self._lock:
+            future, _ = self._in_flight.pop(key, (None, None))
+            if future is None:
+                return
+            if exception is None and keep:
+                self._finished[key] = (future, time.monotonic() + self.ttl, size)
+                self._bytes += size
+                self._evict(time.monotonic())
+        if future.done():
+            return
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return { 'in_flight': len(self._in_flight), 'finished': len(self._finished), 'bytes': self._bytes, 'hits': self.hits }
@@ -0,0 +1,114 @@
+import base64
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from .blob_store import is_blob_ref, BLOB_REF_PREFIX
+
+
+def _image_hash(image:str) -> str:
+    if is_blob_ref(image):
+        return image[len(BLOB_REF_PREFIX):]
+    return hashlib.sha256(base64.b64decode(image)).hexdigest()
+
+
+def response_cache_key(message) -> str:
+    """
+    Key of a TheMessage for ResponseCache: its text with whitespace normalized, the params in its extras
+    and the sha256 of its images, so the same prompt with the same settings maps to the same key
+    """
+    text = message.contents.text
+    if text is not None:
+        text = re.sub(r'\s+', ' ', text).strip()
+    key = {
+        'text': text,
+        'params': (message.extras or {}).get('params'),
+        'images': [_image_hash(img) for img in message.contents.image or []],
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    LRU cache of bot replies with an optional time to live. Entries evicted from memory are pickled
+    to spill_directory if given and loaded back on their next hit.
+    """
+    def __init__(self, max_entries:int=256, ttl:float=None, spill_directory:str=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.spill_directory = spill_directory
+        self._entries = OrderedDict() # key -> (value, created_at), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, created_at:float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def _spill_path(self, key:str) -> str:
+        return os.path.join(self.spill_directory, key + '.pkl')
+
+    def _spill(self, key:str, entry) -> None:
+        if not os.path.exists(self.spill_directory):
+            os.makedirs(self.spill_directory)
+        path = self._spill_path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def _load_spilled(self, key:str):
+        path = self._spill_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f'Failed to load cached response {path} with exception:\n\t', e)
+            return None
+        os.remove(path)
+        return entry
+
+    def get(self, key:str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self.spill_directory:
+                entry = self._load_spilled(key)
+                if entry is not None:
+                    self._put(key, entry)
+            if entry is None or self._expired(entry[1]):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key:str, value:Any) -> None:
+        with self._lock:
+            self._put(key, (value, time.time()))
+
+    def _put(self, key:str, entry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            old_key, old_entry = self._entries.popitem(last=False)
+            if self.spill_directory and not self._expired(old_entry[1]):
+                self._spill(old_key, old_entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,203 @@
+import asyncio
+import heapq
+import itertools
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Executor, Future
+from typing import Callable
+
+
+SKIP = 'skip'
+CATCH_UP = 'catch_up'
+
+
+class _DaemonExecutor(Executor):
+    """
+    Runs the submitted calls one at a time on a daemon thread. The threads of a ThreadPoolExecutor are joined
+    at interpreter exit, so a long timer() would hold up the shutdown of the process until it returns.
+    """
+    def __init__(self, thread_name:str):
+        self._thread_name = thread_name
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._shutdown = False
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name=self._thread_name, daemon=True)
+                self._thread.start()
+            future = Future()
+            self._queue.put((future, fn, args, kwargs))
+            return future
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait:bool=True) -> None:
+        with self._lock:
+            self._shutdown = True
+            self._queue.put(None)
+            thread = self._thread
+        if wait and thread is not None:
+            thread.join()
+
+
+class _TimerJob:
+    def __init__(self, name:str, func:Callable, interval:float, jitter:float, missed:str):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.missed = missed
+        self.executor = _DaemonExecutor(f'timer-{name}')
+        self.runs_pending = [] # Futures of the runs in progress or queued on the executor
+        self.due = None # time.time() of the next run, without jitter
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_duration = None
+
+    def stats(self) -> dict:
+        return {
+            'interval_seconds': self.interval,
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'failures': self.failures,
+            'last_duration_seconds': self.last_duration,
+        }
+
+
+class TimerScheduler:
+    """
+    Runs periodic callbacks from the event loop: the next due timer is kept on a heap and the loop sleeps
+    until it is due, so there are no idle wake ups. Every job runs on its own daemon thread so a
+    slow timer does not delay the others, nor the exit of the process. Runs are aligned on multiples of the interval in wall clock time,
+    delayed by a random jitter in [0, jitter] seconds.
+
+    A run that takes longer than its interval is an overrun and is reported. With missed='skip' the runs that come
+    due while the previous one is still running, or while the loop was blocked (e.g. the machine was suspended),
+    are skipped. With missed='catch_up' they run back to back, with at most one run queued behind the running one.
+    """
+    def __init__(self):
+        self._jobs = []
+        self._heap = []
+        self._counter = itertools.count()
+        self._task = None
+        self._wakeup = None
+
+    def add(self, name:str, func:Callable, interval:float, jitter:float=0, missed:str=SKIP) -> None:
+        """
+        Schedules func every interval seconds. A call returning False did nothing (e.g. another process runs the timer)
+          and is not counted in the stats.
+        """
+        assert interval > 0, 'interval must be positive'
+        assert missed in [SKIP, CATCH_UP], f"missed must be '{SKIP}' or '{CATCH_UP}'"
+        self._jobs.append(_TimerJob(name, func, interval, jitter, missed))
+
+    def start(self) -> None:
+        """
+        Starts the scheduler on the running event loop
+        """
+        if not self._jobs:
+            return
+        now = time.time()
+        for job in self._jobs:
+            job.due = now + job.interval - (now % job.interval)
+            self._push(job)
+        first = min(job.due for job in self._jobs)
+        print(f'\tScheduler sleeping for {first - now:.0f} seconds')
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _push(self, job:_TimerJob) -> None:
+        run_at = job.due + (random.uniform(0, job.jitter) if job.jitter else 0)
+        heapq.heappush(self._heap, (run_at, next(self._counter), job))
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._heap:
+            run_at, _, job = self._heap[0]
+            delay = run_at - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    return # stopped
+                except asyncio.TimeoutError:
+                    continue
+            heapq.heappop(self._heap)
+            self._fire(loop, job)
+            job.due += job.interval
+            now = time.time()
+            if job.due <= now and job.missed == SKIP:
+                missed = int((now - job.due) // job.interval) + 1
+                job.skipped += missed
+                job.due += missed * job.interval
+            self._push(job)
+
+    def _fire(self, loop, job:_TimerJob) -> None:
+        job.runs_pending = [future for future in job.runs_pending if not future.done()]
+        if len(job.runs_pending) >= (2 if job.missed == CATCH_UP else 1):
+            job.skipped += 1
+            return
+
+        def run():
+            start = time.monotonic()
+            result = None
+            try:
+                result = job.func()
+                return result
+            finally:
+                if result is not False:
+                    job.last_duration = time.monotonic() - start
+
+        def done(future):
+            if future.cancelled():
+                return
+            if future.exception() is None and future.result() is False:
+                return
+            job.runs += 1
+            if future.exception() is not None:
+                job.failures += 1
+                print(f'{job.name} timer failed with exception:\n\t', future.exception())
+            if job.last_duration > job.interval:
+                job.overruns += 1
+                print(f'{job.name} WARNING: timer took {job.last_duration:.1f} seconds, longer than its {job.interval} seconds interval')
+        future = loop.run_in_executor(job.executor, run)
+        future.add_done_callback(done)
+        job.runs_pending.append(future)
+
+    def stop(self) -> None:
+        """
+        Stops scheduling right away. A timer that is running is not interrupted but nothing waits for it,
+          it runs on a daemon thread so it is killed if the process exits first.
+        """
+        if self._wakeup is not None:
+            self._wakeup.set()
+        for job in self._jobs:
+            # cancelling the queued runs cancels them on the executor
+            for future in job.runs_pending:
+                future.cancel()
+            job.executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return { job.name: job.stats() for job in self._jobs }
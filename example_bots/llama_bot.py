@@ -8,7 +8,7 @@ class LlamaBot(BaseBotWithLocalDb):
     def respond(self, message: MessageWrapper) -> TheMessage:
         msg = message
         if msg.get_text():
-            context_messages = self.get_message_context(message, limit=5, descending=False)
+            context_messages = self.get_message_context(message, limit=5, descending=False, include_images=False)
             # messages in most recent first order 
             txt = LLAMA_CONDITONING
             for msg in context_messages:
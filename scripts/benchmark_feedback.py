@@ -0,0 +1,98 @@
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import json
+import uuid
+
+from basebot.utils.database_util import JsonUtil, ShardedJsonUtil
+
+
+BOT_ID = 'bot.BenchmarkBot'
+
+
+def synthetic_messages(n_messages, n_users):
+    """
+    Returns user_id -> message list for n_messages alternating user/bot messages spread over n_users
+    """
+    messages = {}
+    ts = time.time() - n_messages
+    for i in range(n_messages):
+        user_id = f'user-{i % n_users}'
+        sender, recipient = (user_id, BOT_ID) if i % 2 == 0 else (BOT_ID, user_id)
+        msg = {
+            'timestamp': ts + i,
+            'sender_id': sender,
+            'recipient_id': recipient,
+            'message_id': str(uuid.uuid4()),
+            'contents': {'text': f'message number {i}', 'image': []},
+            'extras': {},
+        }
+        messages.setdefault(user_id, []).append(msg)
+    return messages
+
+
+def load_json_util(directory, messages, journaled=False):
+    with open(os.path.join(directory, BOT_ID + '_messages.json'), 'w') as f:
+        json.dump(messages, f)
+    return JsonUtil(bot_id=BOT_ID, json_directory=directory, journaled=journaled, compact_every=10**9)
+
+
+def load_journal_util(directory, messages):
+    return load_json_util(directory, messages, journaled=True)
+
+
+def load_sharded_util(directory, messages):
+    shard_directory = os.path.join(directory, BOT_ID)
+    os.makedirs(shard_directory)
+    db_util = ShardedJsonUtil(bot_id=BOT_ID, json_directory=directory)
+    for user_id, user_messages in messages.items():
+        with open(db_util._user_filename(user_id), 'w') as f:
+            for msg in user_messages:
+                f.write(json.dumps({'op': 'save', 'user_id': user_id, 'message': msg}) + '\n')
+    db_util._rebuild_index()
+    return db_util
+
+
+def time_feedback(db_util, message_ids, n_ops, max_seconds):
+    latencies = []
+    deadline = time.perf_counter() + max_seconds
+    for _ in range(n_ops):
+        if latencies and time.perf_counter() > deadline:
+            break
+        message_id = random.choice(message_ids)
+        start = time.perf_counter()
+        db_util.rate_message(BOT_ID, message_id, random.choice([-1.0, 1.0]))
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures rate_message (/feedback) latency as the stored history grows')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000], help='number of stored messages')
+    parser.add_argument('--users', type=int, default=1000, help='number of users the messages are spread over')
+    parser.add_argument('--ops', type=int, default=1000, help='rate_message calls per size')
+    parser.add_argument('--max-seconds', type=float, default=30, help='stop timing a size after this many seconds, fewer than --ops calls are then measured')
+    parser.add_argument('--backends', nargs='+', default=['json', 'journal', 'sharded'], choices=['json', 'journal', 'sharded'])
+    args = parser.parse_args()
+
+    loaders = {'json': load_json_util, 'journal': load_journal_util, 'sharded': load_sharded_util}
+    print(f"{'backend':<10}{'messages':>12}{'ops':>8}{'p50 (us)':>12}{'p99 (us)':>12}")
+    for backend in args.backends:
+        for size in args.sizes:
+            directory = tempfile.mkdtemp()
+            try:
+                messages = synthetic_messages(size, min(args.users, size))
+                message_ids = [msg['message_id'] for user_messages in messages.values() for msg in user_messages]
+                db_util = loaders[backend](directory, messages)
+                del messages
+                latencies = sorted(time_feedback(db_util, message_ids, args.ops, args.max_seconds))
+                db_util.close()
+            finally:
+                shutil.rmtree(directory)
+            p50 = statistics.median(latencies) * 1e6
+            p99 = latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1e6
+            print(f'{backend:<10}{size:>12}{len(latencies):>8}{p50:>12.1f}{p99:>12.1f}')
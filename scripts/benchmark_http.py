@@ -0,0 +1,273 @@
+import argparse
+import base64
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+from basebot import BaseBot, BaseBotWithLocalDb, MessageWrapper
+from basebot.utils.database_util import MongoUtil
+
+
+BACKENDS = ['json', 'journal', 'sharded', 'sqlite', 'mongo', 'mongo-buffered']
+
+
+def random_image_b64(kilobytes):
+    """
+    A JPEG of noise of about the given size, base64 encoded
+    """
+    if not kilobytes:
+        return None
+    side = 16
+    while True:
+        img = Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=95)
+        if buf.tell() >= kilobytes * 1024:
+            return base64.b64encode(buf.getvalue()).decode('utf-8')
+        side = int(side * 1.25) + 1
+
+
+class StubBot(BaseBotWithLocalDb):
+    """
+    Replies after `latency` seconds, with an image attached if reply_image is set
+    """
+    def __init__(self, latency=0.0, reply_image=None, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.reply_image = reply_image
+
+    def respond(self, message):
+        context = self.get_message_context(message, limit=5, include_images=False)
+        if self.latency:
+            time.sleep(self.latency)
+        resp = self.get_message_to(message.get_sender_id())
+        resp.set_text(f'reply to {message.get_text()} with {len(context)} context messages')
+        if self.reply_image:
+            resp.set_images_b64([self.reply_image])
+        return resp
+
+
+def make_bot(backend, directory, args, reply_image):
+    kwargs = dict(latency=args.latency / 1000, reply_image=reply_image, json_directory=directory,
+                  cache_directory=os.path.join(directory, 'bot_cache'), suppress_warnings=True)
+    if backend.startswith('mongo'):
+        buffered = backend == 'mongo-buffered'
+        if args.mongo_uri:
+            os.environ['MONGO_URI'] = args.mongo_uri
+            return StubBot(storage='mongo', write_behind=buffered, **kwargs)
+        # stand-in for a local MongoDB server
+        import mongomock
+        os.environ.setdefault('MONGO_URI', 'mongodb://localhost:27017')
+        db_util = MongoUtil(buffered=buffered)
+        db_util.mongo = mongomock.MongoClient()
+        return StubBot(db_util=db_util, **kwargs)
+    return StubBot(storage=backend, **kwargs)
+
+
+class InProcessClient:
+    """
+    Calls the app through the ASGI test client, no network involved
+    """
+    def __init__(self, app):
+        from fastapi.testclient import TestClient
+        self.client = TestClient(app)
+
+    def __enter__(self):
+        self.client.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.client.__exit__(*exc)
+
+    def post(self, path, payload):
+        return self.client.post(path, json=payload)
+
+
+class LocalhostClient:
+    """
+    Serves the app with uvicorn on localhost in a background thread and calls it over HTTP
+    """
+    def __init__(self, app, port):
+        import uvicorn
+        self.url = f'http://127.0.0.1:{port}'
+        self.server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+        self.local = threading.local()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+    def post(self, path, payload):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session.post(self.url + path, json=payload)
+
+
+def run_load(client, bot, args, request_image):
+    """
+    Sends args.requests requests from args.concurrency threads, each for a random user out of args.users,
+    and returns operation -> list of (latency seconds, ok)
+    """
+    weights = { 'respond': args.respond_weight, 'history': args.history_weight, 'feedback': args.feedback_weight }
+    operations = [op for op, weight in weights.items() if weight > 0]
+    op_weights = [weights[op] for op in operations]
+    endpoint = f'/bots/{bot.endpoint_name}'
+    replies = [] # message ids that can be rated
+    results = { op: [] for op in operations }
+    lock = threading.Lock()
+
+    def one_request(i):
+        rng = random.Random(args.seed * 1_000_003 + i)
+        user_id = f'user-{rng.randrange(args.users)}'
+        op = rng.choices(operations, op_weights)[0]
+        if op == 'feedback' and not replies:
+            op = 'respond'
+        if op == 'respond':
+            msg = MessageWrapper(sender_id=user_id, recipient_id=bot.bot_id)
+            msg.set_text(f'message {i}')
+            if request_image:
+                msg.set_images_b64([request_image])
+            path, payload = '/respond', msg.get_message().dict()
+        elif op == 'history':
+            path, payload = '/history', { 'user_id': user_id, 'limit': 10 }
+        else:
+            path, payload = '/feedback', { 'message_id': rng.choice(replies), 'rating': rng.choice([-1.0, 1.0]) }
+        start = time.perf_counter()
+        try:
+            resp = client.post(endpoint + path, payload)
+            ok = resp.status_code == 200
+        except Exception:
+            resp, ok = None, False
+        latency = time.perf_counter() - start
+        with lock:
+            results[op].append((latency, ok))
+            if ok and op == 'respond':
+                replies.append(resp.json()['message_id'])
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(one_request, range(args.warmup)))
+        for op in results:
+            results[op].clear()
+        start = time.perf_counter()
+        list(executor.map(one_request, range(args.warmup, args.warmup + args.requests)))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def summarize(results, elapsed):
+    summary = { 'elapsed_seconds': elapsed, 'throughput_rps': sum(len(v) for v in results.values()) / elapsed, 'operations': {} }
+    for op, values in results.items():
+        latencies = sorted(latency for latency, _ in values)
+        summary['operations'][op] = {
+            'requests': len(values),
+            'errors': sum(1 for _, ok in values if not ok),
+            'throughput_rps': len(values) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+            'p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+            'mean_ms': statistics.mean(latencies) * 1000 if latencies else None,
+        }
+    return summary
+
+
+def default_backends(mongo_uri):
+    """
+    Every backend but mongo-buffered, leaving out mongo when there is neither a MongoDB nor mongomock to stand in for it
+    """
+    backends = ['json', 'journal', 'sharded', 'sqlite']
+    if mongo_uri or importlib.util.find_spec('mongomock') is not None:
+        backends.append('mongo')
+    else:
+        print('Skipping mongo: set --mongo-uri or `pip install mongomock` to benchmark it')
+    return backends
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load tests /respond, /history and /feedback of a stub bot for each storage backend')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS,
+                        help='defaults to json journal sharded sqlite, and mongo when --mongo-uri is set or mongomock is installed')
+    parser.add_argument('--server', default='inprocess', choices=['inprocess', 'localhost'], help='call the app in-process or serve it with uvicorn on localhost')
+    parser.add_argument('--port', type=int, default=8765, help='port of the localhost server')
+    parser.add_argument('--requests', type=int, default=2000, help='measured requests per backend')
+    parser.add_argument('--warmup', type=int, default=200, help='requests sent before measuring')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--users', type=int, default=100, help='number of distinct users sending messages')
+    parser.add_argument('--respond-weight', type=float, default=0.7)
+    parser.add_argument('--history-weight', type=float, default=0.2)
+    parser.add_argument('--feedback-weight', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds respond() sleeps, to stand in for a model')
+    parser.add_argument('--request-image-kb', type=int, default=0, help='size of the image attached to every message')
+    parser.add_argument('--reply-image-kb', type=int, default=0, help='size of the image attached to every reply')
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI'), help='MongoDB to use, mongomock (pip install mongomock) stands in for it if not set')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='path of the JSON results')
+    args = parser.parse_args()
+    if args.backends is None:
+        args.backends = default_backends(args.mongo_uri)
+
+    random.seed(args.seed)
+    request_image = random_image_b64(args.request_image_kb)
+    reply_image = random_image_b64(args.reply_image_kb)
+    report = {
+        'timestamp': time.time(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        'backends': {},
+    }
+    print(f"{'backend':<16}{'operation':<10}{'requests':>9}{'errors':>7}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for backend in args.backends:
+        directory = tempfile.mkdtemp()
+        try:
+            bot = make_bot(backend, directory, args, reply_image)
+            app = BaseBot.start_app(bot)
+            client = InProcessClient(app) if args.server == 'inprocess' else LocalhostClient(app, args.port)
+            with client:
+                results, elapsed = run_load(client, bot, args, request_image)
+        finally:
+            shutil.rmtree(directory)
+        summary = report['backends'][backend] = summarize(results, elapsed)
+        for op, s in summary['operations'].items():
+            fmt = lambda v: f'{v:>9.1f}' if v is not None else f"{'-':>9}"
+            print(f"{backend:<16}{op:<10}{s['requests']:>9}{s['errors']:>7}{s['throughput_rps']:>9.1f}{fmt(s['p50_ms'])}{fmt(s['p95_ms'])}{fmt(s['p99_ms'])}")
+        print(f"{backend:<16}{'total':<10}{'':>16}{summary['throughput_rps']:>9.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results written to', args.output)
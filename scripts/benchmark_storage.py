@@ -0,0 +1,433 @@
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from basebot.models.the_message import TheMessage, MessageContents
+from basebot.utils.database_util import JsonUtil, ShardedJsonUtil, SqliteUtil, MongoUtil
+
+
+BOT_ID = 'bot.BenchmarkBot'
+BACKENDS = ['json', 'journal', 'sharded', 'sqlite', 'mongo']
+OPERATIONS = ['save', 'history', 'rate', 'clear']
+
+
+def rss_mb():
+    """
+    Resident memory of this process in MB, the peak so far where the current value is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+def peak_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+def disk_mb(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total / 2**20
+
+
+def zipf_counts(n_messages, n_users, skew):
+    """
+    Splits n_messages over n_users so that the user of rank r gets a share proportional to 1 / r^skew,
+    like real traffic where a few users write most of the messages
+    """
+    weights = [1 / (rank ** skew) for rank in range(1, n_users + 1)]
+    total = sum(weights)
+    counts = [int(n_messages * w / total) for w in weights]
+    for i in range(n_messages - sum(counts)):
+        counts[i % n_users] += 1
+    return counts
+
+
+def user_id(u):
+    return f'user-{u}'
+
+
+def message_id(u, j):
+    # deterministic so any stored message can be rated without keeping all the ids around
+    return str(uuid.UUID(int=(u << 40) | j))
+
+
+class History:
+    """
+    A synthetic history: alternating user/bot messages per user, one every second, with an inline image
+    on image_fraction of the user messages
+    """
+    def __init__(self, counts, image_b64, image_fraction, seed):
+        self.counts = counts
+        self.image_b64 = image_b64
+        self.image_fraction = image_fraction
+        self.seed = seed
+        self.start_ts = time.time() - max(counts) - 3600
+        self.cum_weights = []
+        total = 0
+        for count in counts:
+            total += count
+            self.cum_weights.append(total)
+
+    def message(self, u, j, ts=None, rng=None):
+        sender, recipient = (user_id(u), BOT_ID) if j % 2 == 0 else (BOT_ID, user_id(u))
+        images = []
+        if self.image_b64 and j % 2 == 0 and (rng or random).random() < self.image_fraction:
+            images = [self.image_b64]
+        return {
+            'timestamp': self.start_ts + j if ts is None else ts,
+            'sender_id': sender,
+            'recipient_id': recipient,
+            'message_id': message_id(u, j),
+            'contents': {'text': f'message number {j} of {user_id(u)}', 'image': images},
+            'extras': {},
+        }
+
+    def user_messages(self, u):
+        rng = random.Random(self.seed * 1_000_003 + u)
+        for j in range(self.counts[u]):
+            yield self.message(u, j, rng=rng)
+
+    def users(self):
+        return [u for u, count in enumerate(self.counts) if count]
+
+    def pick_user(self, rng):
+        """
+        A user picked with the same skew as the stored history, so busy users get most of the traffic
+        """
+        return rng.choices(range(len(self.counts)), cum_weights=self.cum_weights)[0]
+
+
+def load_json(directory, history, journaled):
+    with open(os.path.join(directory, BOT_ID + '_messages.json'), 'w') as f:
+        f.write('{')
+        for i, u in enumerate(history.users()):
+            if i:
+                f.write(', ')
+            f.write(json.dumps(user_id(u)) + ': ' + json.dumps(list(history.user_messages(u))))
+        f.write('}')
+    start = time.perf_counter()
+    db_util = JsonUtil(bot_id=BOT_ID, json_directory=directory, journaled=journaled)
+    return db_util, time.perf_counter() - start
+
+
+def load_sharded(directory, history):
+    db_util = ShardedJsonUtil(bot_id=BOT_ID, json_directory=directory)
+    for u in history.users():
+        with open(db_util._user_filename(user_id(u)), 'w') as f:
+            for msg in history.user_messages(u):
+                f.write(json.dumps({'op': 'save', 'user_id': user_id(u), 'message': msg}) + '\n')
+    db_util._rebuild_index()
+    db_util.close()
+    start = time.perf_counter()
+    db_util = ShardedJsonUtil(bot_id=BOT_ID, json_directory=directory)
+    return db_util, time.perf_counter() - start
+
+
+def load_sqlite(directory, history):
+    db_path = os.path.join(directory, BOT_ID + '.sqlite')
+    db_util = SqliteUtil(db_path)
+    conn = db_util._connection()
+    with conn:
+        for u in history.users():
+            conn.executemany('INSERT INTO messages (bot, message_id, sender_id, recipient_id, timestamp, message) VALUES (?, ?, ?, ?, ?, ?)',
+                             ((BOT_ID, msg['message_id'], msg['sender_id'], msg['recipient_id'], msg['timestamp'], json.dumps(msg))
+                              for msg in history.user_messages(u)))
+    db_util.close()
+    start = time.perf_counter()
+    db_util = SqliteUtil(db_path)
+    return db_util, time.perf_counter() - start
+
+
+def load_mongo(history, mongo_uri, collection):
+    if mongo_uri:
+        os.environ['MONGO_URI'] = mongo_uri
+        db_util = MongoUtil()
+    else:
+        # stand-in for a local MongoDB server
+        import mongomock
+        os.environ.setdefault('MONGO_URI', 'mongodb://localhost:27017')
+        db_util = MongoUtil()
+        db_util.mongo = mongomock.MongoClient()
+    for u in history.users():
+        db_util.mongo.db[collection].insert_many(list(history.user_messages(u)))
+    start = time.perf_counter()
+    # the indexes BaseBotWithLocalDb creates for MongoDB
+    db_util.create_index_if_not_exists(collection, 'sender_id')
+    db_util.create_index_if_not_exists(collection, 'recipient_id')
+    return db_util, time.perf_counter() - start
+
+
+def timed_ops(n_ops, max_seconds, op):
+    """
+    Runs op(i) up to n_ops times, stopping early once max_seconds have passed, and returns the latencies
+    """
+    latencies = []
+    deadline = time.perf_counter() + max_seconds
+    for i in range(n_ops):
+        start = time.perf_counter()
+        op(i)
+        end = time.perf_counter()
+        latencies.append(end - start)
+        if end > deadline:
+            break
+    return latencies
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def summarize(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    return {
+        'ops': len(latencies),
+        'ops_per_second': len(latencies) / sum(latencies) if sum(latencies) else None,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+    }
+
+
+def run_one(args):
+    """
+    Loads a synthetic history of args.size messages into one backend and times each operation on it.
+    Runs in its own process so the memory numbers only cover this backend and this size.
+    """
+    rng = random.Random(args.seed)
+    image_b64 = base64.b64encode(os.urandom(args.image_kb * 1024 * 3 // 4)).decode('utf-8') if args.images == 'inline' else None
+    history = History(zipf_counts(args.size, min(args.users, args.size), args.skew), image_b64, args.image_fraction, args.seed)
+    directory = tempfile.mkdtemp(dir=args.directory)
+    collection = f'{BOT_ID}-{uuid.uuid4().hex[:8]}'
+    bot = collection if args.backend == 'mongo' else BOT_ID
+    db_util = None
+    result = {}
+    try:
+        baseline_mb = rss_mb()
+        start = time.perf_counter()
+        if args.backend in ['json', 'journal']:
+            db_util, open_seconds = load_json(directory, history, journaled=args.backend == 'journal')
+        elif args.backend == 'sharded':
+            db_util, open_seconds = load_sharded(directory, history)
+        elif args.backend == 'sqlite':
+            db_util, open_seconds = load_sqlite(directory, history)
+        else:
+            db_util, open_seconds = load_mongo(history, args.mongo_uri, collection)
+        result['load_seconds'] = time.perf_counter() - start
+        result['open_seconds'] = open_seconds
+        result['rss_after_open_mb'] = rss_mb() - baseline_mb
+        result['disk_mb'] = disk_mb(directory) if args.backend != 'mongo' else None
+
+        def save(i):
+            u = history.pick_user(rng)
+            j = history.counts[u]
+            history.counts[u] += 1
+            msg = history.message(u, j, ts=time.time(), rng=rng)
+            db_util.save_chat_message(bot, TheMessage(**dict(msg, contents=MessageContents(**msg['contents']))))
+
+        def page_through(i):
+            # the newest page then older ones with before_ts, like scrolling up the chat
+            u = history.pick_user(rng)
+            before_ts = None
+            for _ in range(args.pages):
+                page = db_util.get_chat_messages(bot, user_id(u), limit=args.page_size, before_ts=before_ts)
+                if len(page) < args.page_size:
+                    break
+                before_ts = page[-1].timestamp
+
+        def rate(i):
+            u = history.pick_user(rng)
+            db_util.rate_message(bot, message_id(u, rng.randrange(history.counts[u])), rng.choice([-1.0, 1.0]))
+
+        # clearing is destructive, so the cleared users are taken last and never reused
+        cleared = iter(rng.sample(history.users(), min(args.clear_ops, len(history.users()))))
+
+        def clear(i):
+            u = next(cleared)
+            db_util.clear_chat_history(bot, user_id(u))
+            history.counts[u] = 0
+
+        ops = { 'save': (save, args.ops), 'history': (page_through, args.ops), 'rate': (rate, args.ops), 'clear': (clear, args.clear_ops) }
+        result['operations'] = {}
+        for name in args.operations:
+            op, n_ops = ops[name]
+            result['operations'][name] = summarize(timed_ops(n_ops, args.op_seconds, op))
+        result['rss_after_ops_mb'] = rss_mb() - baseline_mb
+        result['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        if db_util is not None:
+            if args.backend == 'mongo':
+                db_util.mongo.db.drop_collection(collection)
+            db_util.close()
+        shutil.rmtree(directory)
+    return result
+
+
+def run_in_subprocess(args, backend, size, images):
+    command = [sys.executable, os.path.abspath(__file__), '--run-one', '--backend', backend, '--size', str(size), '--images', images,
+               '--users', str(args.users), '--skew', str(args.skew), '--image-kb', str(args.image_kb), '--image-fraction', str(args.image_fraction),
+               '--ops', str(args.ops), '--clear-ops', str(args.clear_ops), '--pages', str(args.pages), '--page-size', str(args.page_size),
+               '--op-seconds', str(args.op_seconds), '--seed', str(args.seed), '--operations', *args.operations]
+    if args.mongo_uri:
+        command += ['--mongo-uri', args.mongo_uri]
+    if args.directory:
+        command += ['--directory', args.directory]
+    try:
+        proc = subprocess.run(command, capture_output=True, text=True, timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+        return { 'error': f'timed out after {args.timeout} seconds' }
+    if proc.returncode != 0:
+        return { 'error': (proc.stderr.strip().splitlines() or [f'exit code {proc.returncode}'])[-1] }
+    # the backends may print, the result is the last line
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def default_backends(mongo_uri):
+    """
+    Every backend, leaving out mongo when there is neither a MongoDB nor mongomock to stand in for it
+    """
+    if mongo_uri or importlib.util.find_spec('mongomock') is not None:
+        return list(BACKENDS)
+    print('Skipping mongo: set --mongo-uri or `pip install mongomock` to benchmark it')
+    return [backend for backend in BACKENDS if backend != 'mongo']
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def print_curves(report, args):
+    """
+    One table per operation: ops/sec of every backend as the history grows
+    """
+    fmt = lambda v: f'{v:>12.0f}' if v is not None else f"{'-':>12}"
+    header = f"{'backend':<10}{'images':<8}" + ''.join(f'{size:>12,}' for size in args.sizes)
+    for name in ['open seconds', 'memory MB'] + [f'{op} ops/sec' for op in args.operations]:
+        print()
+        print(name)
+        print(header)
+        for key, runs in report['runs'].items():
+            backend, images = key.split('/')
+            row = f'{backend:<10}{images:<8}'
+            for size in args.sizes:
+                run = runs.get(str(size))
+                if run is None or 'error' in run:
+                    row += f"{'x' if run else '-':>12}"
+                elif name == 'open seconds':
+                    row += f"{run['open_seconds']:>12.2f}"
+                elif name == 'memory MB':
+                    row += fmt(run['rss_after_ops_mb'])
+                else:
+                    stats = run['operations'].get(name.split()[0])
+                    row += fmt(stats['ops_per_second'] if stats else None)
+            print(row)
+    print("\nx: the run failed or timed out, larger sizes were skipped. '-': not run.")
+
+
+def plot_curves(report, args, path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(1, len(args.operations), figsize=(5 * len(args.operations), 4), squeeze=False)
+    for ax, op in zip(axes[0], args.operations):
+        for key, runs in report['runs'].items():
+            points = [(int(size), run['operations'][op]['ops_per_second']) for size, run in runs.items()
+                      if 'error' not in run and run['operations'].get(op) and run['operations'][op]['ops_per_second']]
+            if points:
+                ax.plot(*zip(*points), marker='o', label=key)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_title(op)
+        ax.set_xlabel('stored messages')
+        ax.set_ylabel('ops/sec')
+        ax.legend(fontsize='small')
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures every DbUtil directly as the stored history grows: save, paginated history, '
+                                                 'rate_message and clear_chat_history throughput, startup time and memory')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, help='defaults to all, mongo only when --mongo-uri is set or mongomock is installed')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000], help='number of stored messages, up to 10M')
+    parser.add_argument('--users', type=int, default=10_000, help='number of users the messages are spread over')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the messages per user, 0 spreads them evenly')
+    parser.add_argument('--images', nargs='+', default=['none', 'inline'], choices=['none', 'inline'], help='run without and/or with inline base64 images')
+    parser.add_argument('--image-kb', type=int, default=32, help='size of the base64 images')
+    parser.add_argument('--image-fraction', type=float, default=0.1, help='fraction of the user messages with an image')
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument('--ops', type=int, default=1000, help='save, history and rate calls per run')
+    parser.add_argument('--clear-ops', type=int, default=20, help='clear_chat_history calls per run')
+    parser.add_argument('--pages', type=int, default=3, help='history pages read per history call')
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--op-seconds', type=float, default=30, help='stop timing an operation after this many seconds')
+    parser.add_argument('--timeout', type=float, default=1800, help='seconds a run may take before its backend is given up on for larger sizes')
+    parser.add_argument('--directory', help='where to put the stores, the system temp directory by default')
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI'), help='MongoDB to use, mongomock (pip install mongomock) stands in for it if not set')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='path of the JSON results')
+    parser.add_argument('--plot', help='path of a PNG of the scaling curves, needs matplotlib')
+    parser.add_argument('--run-one', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--backend', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        args.images = args.images[0]
+        print(json.dumps(run_one(args)))
+        sys.exit(0)
+    if args.backends is None:
+        args.backends = default_backends(args.mongo_uri)
+
+    report = {
+        'timestamp': time.time(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        'runs': {}, # backend/images -> size -> result
+    }
+    print(f"{'backend':<10}{'images':<8}{'messages':>12}{'open s':>9}{'mem MB':>9}{'disk MB':>9}  ops/sec (p99 ms)")
+    for backend in args.backends:
+        for images in args.images:
+            runs = report['runs'][f'{backend}/{images}'] = {}
+            for size in sorted(args.sizes):
+                result = runs[str(size)] = run_in_subprocess(args, backend, size, images)
+                if 'error' in result:
+                    print(f"{backend:<10}{images:<8}{size:>12,}  {result['error']}")
+                    break
+                ops = '  '.join(f"{op} {s['ops_per_second']:.0f} ({s['p99_ms']:.1f})" for op, s in result['operations'].items() if s)
+                disk = f"{result['disk_mb']:>9.1f}" if result['disk_mb'] is not None else f"{'-':>9}"
+                print(f"{backend:<10}{images:<8}{size:>12,}{result['open_seconds']:>9.2f}{result['rss_after_ops_mb']:>9.1f}{disk}  {ops}")
+    print_curves(report, args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results written to', args.output)
+    if args.plot:
+        plot_curves(report, args, args.plot)
+        print('Plot written to', args.plot)
@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+# must not be loaded by a bare `import basebot`, they are imported when first used
+LAZY_MODULES = ['PIL', 'numpy', 'pymongo', 'bson', 'motor', 'requests', 'jinja2', 'fastapi.templating', 'fastapi.staticfiles']
+
+MEASURE = '''
+import json, os, resource, sys, time
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+before = rss_mb()
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{ 'ms': seconds * 1000, 'rss_mb': rss_mb() - before, 'modules': sorted(sys.modules) }}))
+'''
+
+
+def measure(module, root):
+    """
+    Imports module in a fresh interpreter and returns its import time, memory and the modules it loaded
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    out = subprocess.check_output([sys.executable, '-c', MEASURE.format(module=module)], env=env, cwd=root)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def slowest_imports(module, root, n):
+    """
+    The n modules with the highest cumulative import time, from python -X importtime
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], env=env, cwd=root, capture_output=True, text=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks that `import basebot` stays within its time budget and does not load the heavy optional dependencies')
+    parser.add_argument('--module', default='basebot')
+    parser.add_argument('--budget-ms', type=float, default=400, help='median import time allowed')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to measure, the median is compared to the budget')
+    parser.add_argument('--output', help='path of the JSON results')
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # a first run so the budget is not spent compiling .pyc files
+    measure(args.module, root)
+    runs = [measure(args.module, root) for _ in range(args.runs)]
+    median_ms = statistics.median(run['ms'] for run in runs)
+    rss_mb = statistics.median(run['rss_mb'] for run in runs)
+    loaded = [name for name in LAZY_MODULES if name in runs[-1]['modules']]
+    print(f'import {args.module}: {median_ms:.0f} ms median of {args.runs} runs (budget {args.budget_ms:.0f} ms), +{rss_mb:.1f} MB RSS, {len(runs[-1]["modules"])} modules')
+
+    failures = []
+    if median_ms > args.budget_ms:
+        failures.append(f'import time {median_ms:.0f} ms is over the {args.budget_ms:.0f} ms budget')
+    if loaded:
+        failures.append(f'heavy modules loaded at import time: {", ".join(loaded)}')
+    if failures:
+        print('Slowest imports (cumulative ms):')
+        for ms, name in slowest_imports(args.module, root, 15):
+            print(f'{ms:>10.1f}  {name}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ 'module': args.module, 'median_ms': median_ms, 'budget_ms': args.budget_ms, 'rss_mb': rss_mb,
+                        'runs_ms': [run['ms'] for run in runs], 'lazy_modules_loaded': loaded }, f, indent=2)
+    for failure in failures:
+        print('FAIL:', failure)
+    sys.exit(1 if failures else 0)
@@ -8,7 +8,7 @@ class ChatGPTBot(BaseBotWithLocalDb):
     def respond(self, message: MessageWrapper) -> MessageWrapper:
         if message.get_text():
             # get previous messages, oldest message first
-            context_messages = self.get_message_context(message, limit=5, descending=False) 
+            context_messages = self.get_message_context(message, limit=5, descending=False, include_images=False)
             chatgpt_messages = []
             for msg in context_messages:
                 if msg.get_sender_id() == message.get_sender_id() and msg.get_text():
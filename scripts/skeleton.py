@@ -9,7 +9,7 @@ class BaseBotSkeleton(BaseBot):
     def help(self) -> str:
         raise NotImplementedError("TODO implement this function")
 
-    def get_message_history(self, user_id: str, limit=10, before_ts=None, descending: bool = True) -> List[TheMessage]:
+    def get_message_history(self, user_id: str, limit=10, before_ts=None, descending: bool = True, include_images: bool = True) -> List[TheMessage]:
         raise NotImplementedError("TODO implement this function")
 
     def respond(self, message: MessageWrapper) -> MessageWrapper:
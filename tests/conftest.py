@@ -0,0 +1,21 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from basebot import BaseBot, MessageWrapper
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    # bots render templates/<name>.html when run from a directory with templates/ and static/, like the repo root
+    monkeypatch.chdir(tmp_path)
+
+
+def make_message(sender_id, text, recipient_id):
+    msg = MessageWrapper(sender_id=sender_id, recipient_id=recipient_id)
+    msg.set_text(text)
+    return msg.get_message()
+
+
+def post_respond(bot, text, sender_id='user-1'):
+    with TestClient(BaseBot.start_app(bot)) as client:
+        return client.post(f'/bots/{bot.endpoint_name}/respond', json=make_message(sender_id, text, bot.bot_id).dict())
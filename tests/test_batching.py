@@ -0,0 +1,46 @@
+import pytest
+
+from basebot import BaseBot
+from conftest import post_respond
+
+
+class AsyncEchoBot(BaseBot):
+    async def respond(self, message):
+        resp = self.get_message_to(message.get_sender_id())
+        resp.set_text(f'echo {message.get_text()}')
+        return resp
+
+
+class AsyncBatchedEchoBot(AsyncEchoBot):
+    def respond_batch(self, messages):
+        replies = []
+        for message in messages:
+            resp = self.get_message_to(message.get_sender_id())
+            resp.set_text(f'batched {message.get_text()}')
+            replies.append(resp)
+        return replies
+
+
+class GeneratorEchoBot(BaseBot):
+    def respond(self, message):
+        yield 'echo '
+        yield message.get_text()
+
+
+def test_async_respond_without_respond_batch_is_rejected():
+    with pytest.raises(ValueError, match='max_batch_size'):
+        AsyncEchoBot(max_batch_size=4, suppress_warnings=True)
+
+
+def test_async_respond_with_respond_batch():
+    bot = AsyncBatchedEchoBot(max_batch_size=4, suppress_warnings=True)
+    resp = post_respond(bot, 'hi')
+    assert resp.status_code == 200
+    assert resp.json()['contents']['text'] == 'batched hi'
+
+
+def test_generator_respond_is_assembled():
+    bot = GeneratorEchoBot(max_batch_size=4, suppress_warnings=True)
+    resp = post_respond(bot, 'hi')
+    assert resp.status_code == 200
+    assert resp.json()['contents']['text'] == 'echo hi'
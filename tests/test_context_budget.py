@@ -0,0 +1,56 @@
+from basebot import BaseBot, BaseBotWithLocalDb
+from conftest import make_message, post_respond
+
+
+class ListHistoryBot(BaseBot):
+    """
+    Keeps its history in a list and overrides get_message_history() without include_images, like scripts/skeleton.py
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = []
+
+    def save_chat_message(self, message):
+        self.messages.append(message)
+
+    def get_message_history(self, user_id, limit=10, before_ts=None, descending=True):
+        messages = [m for m in self.messages if before_ts is None or m.timestamp < before_ts]
+        return list(reversed(messages))[:limit]
+
+    def respond(self, message):
+        resp = self.get_message_to(message.get_sender_id())
+        resp.set_text(f'echo {message.get_text()}')
+        return resp
+
+
+class EchoBot(BaseBotWithLocalDb):
+    def respond(self, message):
+        resp = self.get_message_to(message.get_sender_id())
+        resp.set_text(f'echo {message.get_text()}')
+        return resp
+
+
+def test_budget_with_history_override_without_include_images():
+    bot = ListHistoryBot(suppress_warnings=True)
+    for text in ['one', 'two', 'three']:
+        bot.save_chat_message(make_message('user-1', text, bot.bot_id))
+    context = bot.get_message_context_budget(make_message('user-1', 'four', bot.bot_id), max_tokens=8)
+    assert [m.get_text() for m in context] == ['three', 'two']
+
+
+def test_anonymous_tokenizers_are_not_mixed_up():
+    bot = ListHistoryBot(suppress_warnings=True)
+    bot.save_chat_message(make_message('user-1', 'a b', bot.bot_id))
+    message = make_message('user-1', 'next', bot.bot_id)
+    assert len(bot.get_message_context_budget(message, max_tokens=3, count_tokens=lambda text: len(text))) == 1
+    # a different lambda, counting words, must not reuse the counts of the first one
+    assert len(bot.get_message_context_budget(message, max_tokens=2, count_tokens=lambda text: len(text.split()))) == 1
+    assert len(bot.get_message_context_budget(message, max_tokens=2, count_tokens=lambda text: len(text))) == 0
+
+
+def test_token_counts_are_not_sent_to_clients():
+    bot = EchoBot(suppress_warnings=True)
+    resp = post_respond(bot, 'hi')
+    assert resp.status_code == 200
+    assert 'token_counts' not in (resp.json().get('extras') or {})
+    assert all('token_counts' not in (m.extras or {}) for m in bot.get_message_history('user-1'))
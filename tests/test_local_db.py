@@ -0,0 +1,31 @@
+from basebot import BaseBotWithLocalDb
+from basebot.utils.database_util import JsonUtil
+from conftest import make_message
+
+
+class EchoBot(BaseBotWithLocalDb):
+    def respond(self, message):
+        resp = self.get_message_to(message.get_sender_id())
+        resp.set_text(f'echo {message.get_text()}')
+        return resp
+
+
+def test_default_storage_keeps_the_history_of_the_json_store(monkeypatch):
+    monkeypatch.delenv('MONGO_URI', raising=False)
+    bot = EchoBot(storage='json', suppress_warnings=True)
+    message = make_message('user-1', 'hello', bot.bot_id)
+    bot.save_chat_message(message)
+    bot.db_util.close()
+
+    bot = EchoBot(suppress_warnings=True)
+    assert isinstance(bot.db_util, JsonUtil) and bot.db_util.journaled
+    assert [m.contents.text for m in bot.get_message_history('user-1')] == ['hello']
+    # feedback is appended to the journal, the snapshot is not rewritten
+    with open(bot.db_util.json_name) as f:
+        snapshot = f.read()
+    bot.feedback(message.message_id, 1.0)
+    with open(bot.db_util.json_name) as f:
+        assert f.read() == snapshot
+    with open(bot.db_util.journal_name) as f:
+        assert len(f.readlines()) == 1
+    bot.db_util.close()
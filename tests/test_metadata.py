@@ -0,0 +1,20 @@
+from starlette.requests import Request
+
+from basebot import BaseBot
+from basebot.models import basebot_models
+
+
+def test_metadata_table_keeps_the_recently_used_entries(monkeypatch):
+    monkeypatch.setattr(basebot_models, 'METADATA_CACHE_SIZE', 2)
+    bot = BaseBot(suppress_warnings=True)
+    request = Request({ 'type': 'http', 'method': 'GET', 'headers': [] })
+    builds = []
+
+    def serve(key):
+        return bot._metadata_response(request, key, lambda: builds.append(key) or '{}')
+    serve('hot')
+    serve('a')
+    serve('hot')
+    serve('b')
+    serve('hot')
+    assert builds == ['hot', 'a', 'b']
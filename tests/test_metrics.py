@@ -0,0 +1,23 @@
+from fastapi.testclient import TestClient
+
+from basebot import BaseBot, BaseBotWithLocalDb
+from conftest import make_message
+
+
+class AsyncEchoBot(BaseBotWithLocalDb):
+    async def respond(self, message):
+        resp = self.get_message_to(message.get_sender_id())
+        resp.set_text(f'echo {message.get_text()}')
+        return resp
+
+
+def test_async_storage_calls_are_timed_once():
+    bot = AsyncEchoBot(storage='json', suppress_warnings=True)
+    with TestClient(BaseBot.start_app(bot, metrics=True)) as client:
+        client.post(f'/bots/{bot.endpoint_name}/respond', json=make_message('user-1', 'hi', bot.bot_id).dict())
+        metrics = client.get('/metrics').text
+    saves = [line for line in metrics.splitlines()
+             if line.startswith('basebot_storage_duration_seconds_count') and 'save_chat_message' in line]
+    assert len(saves) == 1 and 'backend="JsonUtil"' in saves[0]
+    # the message and the reply
+    assert saves[0].split()[-1] in ['2', '2.0']
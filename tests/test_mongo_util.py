@@ -0,0 +1,62 @@
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from basebot.utils import database_util
+from basebot.utils.database_util import MongoUtil
+from conftest import make_message
+
+
+BOT_ID = 'bot.TestBot'
+
+
+class FlakyMongo:
+    """
+    mongomock client whose bulk_write raises the given errors before writing
+    """
+    def __init__(self, errors):
+        self.client = mongomock.MongoClient()
+        self.errors = list(errors)
+        self.db = self
+
+    def __getitem__(self, bot):
+        collection = self.client.db[bot]
+        mongo = self
+
+        class Collection:
+            def __getattr__(self, name):
+                return getattr(collection, name)
+
+            def bulk_write(self, requests, ordered=True):
+                if mongo.errors:
+                    raise mongo.errors.pop(0)
+                return collection.bulk_write(requests, ordered=ordered)
+        return Collection()
+
+
+@pytest.fixture
+def buffered_util(monkeypatch):
+    monkeypatch.setenv('MONGO_URI', 'mongodb://localhost:27017')
+    monkeypatch.setattr(database_util, 'MONGO_RETRY_BACKOFF', 0)
+    db_util = MongoUtil(buffered=True)
+    yield db_util
+    db_util.close()
+
+
+def test_network_errors_are_retried(buffered_util):
+    buffered_util.mongo = FlakyMongo([AutoReconnect('down'), AutoReconnect('still down')])
+    buffered_util.save_chat_message(BOT_ID, make_message('alice', 'hello', BOT_ID))
+    buffered_util.flush()
+    assert [m.contents.text for m in buffered_util.get_chat_messages(BOT_ID, 'alice')] == ['hello']
+    assert not buffered_util._unflushed
+
+
+def test_only_rejected_writes_are_lost(buffered_util, capsys):
+    error = BulkWriteError({ 'writeErrors': [{ 'index': 0, 'errmsg': 'rejected' }] })
+    buffered_util.mongo = FlakyMongo([error])
+    buffered_util.save_chat_message(BOT_ID, make_message('alice', 'hello', BOT_ID))
+    buffered_util.save_chat_message(BOT_ID, make_message('alice', 'again', BOT_ID))
+    buffered_util.flush()
+    assert 'failed to write 1 of 2 buffered writes' in capsys.readouterr().out
+    assert not buffered_util._unflushed
@@ -0,0 +1,46 @@
+import asyncio
+import sys
+import time
+
+from basebot.utils.profiler import RequestProfiler
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+async def slow_request(profiler):
+    with profiler.profile('slow', frame=sys._getframe()):
+        for _ in range(8):
+            spin(0.02)
+            await asyncio.sleep(0)
+
+
+async def fast_request(profiler):
+    await asyncio.sleep(0)
+    with profiler.profile('fast', frame=sys._getframe()):
+        for _ in range(2):
+            spin(0.02)
+            await asyncio.sleep(0)
+
+
+def read_profile(profiler, message_id):
+    name = next(name for name in profiler.list() if f'_{message_id}_' in name)
+    with open(profiler.path(name)) as f:
+        return [line.rsplit(' ', 1) for line in f.read().splitlines()]
+
+
+def test_overlapping_async_requests_get_their_own_samples(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), every=1, interval=0.001)
+
+    async def main():
+        await asyncio.gather(slow_request(profiler), fast_request(profiler))
+    asyncio.run(main())
+
+    slow, fast = read_profile(profiler, 'slow'), read_profile(profiler, 'fast')
+    assert slow and fast
+    assert all('slow_request' in stack and 'fast_request' not in stack for stack, _ in slow)
+    assert all('fast_request' in stack and 'slow_request' not in stack for stack, _ in fast)
+    assert sum(int(count) for _, count in slow) > sum(int(count) for _, count in fast)
@@ -0,0 +1,74 @@
+import time
+
+from fastapi.testclient import TestClient
+
+from basebot import BaseBot
+from basebot.utils.reply_table import ReplyTable
+from conftest import make_message
+
+
+def test_finished_replies_are_bounded_by_bytes():
+    table = ReplyTable(max_entries=100, ttl=60, max_bytes=2500)
+    for i in range(5):
+        future, owner = table.claim(i)
+        assert owner
+        table.finish(i, f'reply {i}', size=1000)
+        assert future.result() == f'reply {i}'
+    assert table.stats()['finished'] == 2
+    assert table.get(0) is None
+    assert table.get(4).result() == 'reply 4'
+
+
+def test_unfinished_requests_are_forgotten_after_ttl():
+    table = ReplyTable(ttl=0.05)
+    future, owner = table.claim('key')
+    assert owner
+    time.sleep(0.1)
+    retry, owner = table.claim('key')
+    assert owner
+    # a late reply of the first owner also answers the retry
+    table.finish('key', 'late')
+    assert retry.result() == 'late'
+    assert table.stats() == { 'in_flight': 0, 'finished': 1, 'bytes': 0, 'hits': 0 }
+
+
+def test_cancelled_waiters_do_not_break_finish():
+    table = ReplyTable()
+    future, _ = table.claim('key')
+    future.cancel()
+    table.finish('key', 'reply')
+    assert table.stats()['finished'] == 1
+
+
+class CreditsBot(BaseBot):
+    """
+    Rejects messages until credits are added
+    """
+    credits = 0
+
+    def charge_credits(self, message_id):
+        if self.credits <= 0:
+            return False
+        self.credits -= 1
+        return True
+
+    def respond(self, message):
+        resp = self.get_message_to(message.get_sender_id())
+        resp.set_text(f'echo {message.get_text()}')
+        return resp
+
+    def save_chat_message(self, message):
+        pass
+
+
+def test_rejected_messages_are_answered_again_on_retry():
+    bot = CreditsBot(suppress_warnings=True)
+    message = make_message('user-1', 'hi', bot.bot_id).dict()
+    with TestClient(BaseBot.start_app(bot)) as client:
+        url = f'/bots/{bot.endpoint_name}/respond'
+        assert 'not have enough credits' in client.post(url, json=message).json()['contents']['text']
+        bot.credits = 1
+        assert client.post(url, json=message).json()['contents']['text'] == 'echo hi'
+        # the reply is remembered now, the retry is not charged again
+        assert client.post(url, json=message).json()['contents']['text'] == 'echo hi'
+    assert bot.credits == 0
@@ -0,0 +1,48 @@
+import threading
+
+from basebot.utils.database_util import ShardedJsonUtil
+from conftest import make_message
+
+
+BOT_ID = 'bot.TestBot'
+
+
+def test_reload_after_eviction_waits_for_the_batch_being_committed(tmp_path):
+    db_util = ShardedJsonUtil(bot_id=BOT_ID, json_directory=str(tmp_path), max_users=1, write_behind=True, flush_size=1)
+    committer = db_util._committer
+    commit = committer.commit
+    started, release = threading.Event(), threading.Event()
+
+    def slow_commit(batch):
+        # the batch has been taken from the queue but is not on disk yet
+        started.set()
+        release.wait(5)
+        commit(batch)
+    committer.commit = slow_commit
+
+    db_util.save_chat_message(BOT_ID, make_message('alice', 'hello', BOT_ID))
+    assert started.wait(5)
+    threading.Timer(0.2, release.set).start()
+    # evicts alice without queueing another write, so nothing is pending while her batch is committed
+    db_util.get_chat_messages(BOT_ID, 'bob', limit=10)
+    assert 'alice' not in db_util.conversations
+
+    messages = db_util.get_chat_messages(BOT_ID, 'alice', limit=10)
+    assert [m.contents.text for m in messages] == ['hello']
+    committer.commit = commit
+    db_util.close()
+
+
+def test_feedback_on_evicted_user_is_kept(tmp_path):
+    db_util = ShardedJsonUtil(bot_id=BOT_ID, json_directory=str(tmp_path), max_users=1, write_behind=True)
+    message = make_message('alice', 'hello', BOT_ID)
+    db_util.save_chat_message(BOT_ID, message)
+    db_util.save_chat_message(BOT_ID, make_message('bob', 'hi', BOT_ID))
+    db_util.rate_message(BOT_ID, message.message_id, 1.0)
+    assert 'alice' not in db_util.conversations
+    assert db_util.get_message(message.message_id)['feedback'] == 1.0
+    db_util.close()
+
+    db_util = ShardedJsonUtil(bot_id=BOT_ID, json_directory=str(tmp_path))
+    assert db_util.get_message(message.message_id)['feedback'] == 1.0
+    db_util.close()
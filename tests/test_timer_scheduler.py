@@ -0,0 +1,48 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from basebot.utils.timer_scheduler import TimerScheduler
+
+
+EXIT_WHILE_TIMER_RUNS = '''
+import asyncio, time
+from basebot.utils.timer_scheduler import TimerScheduler
+
+async def main():
+    scheduler = TimerScheduler()
+    scheduler.add('sleepy', lambda: time.sleep(30), interval=0.05)
+    scheduler.start()
+    await asyncio.sleep(0.3)
+    scheduler.stop()
+asyncio.run(main())
+'''
+
+
+def test_exit_does_not_wait_for_a_running_timer():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    start = time.monotonic()
+    subprocess.run([sys.executable, '-c', EXIT_WHILE_TIMER_RUNS], env=env, check=True, timeout=20, capture_output=True)
+    assert time.monotonic() - start < 10
+
+
+def test_calls_returning_false_are_not_counted():
+    ran = []
+
+    def follower():
+        ran.append(True)
+        return False
+
+    async def main():
+        scheduler = TimerScheduler()
+        scheduler.add('follower', follower, interval=0.02)
+        scheduler.start()
+        await asyncio.sleep(0.2)
+        scheduler.stop()
+        return scheduler.stats()['follower']
+    stats = asyncio.run(main())
+    assert ran
+    assert stats['runs'] == 0 and stats['last_duration_seconds'] is None